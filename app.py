@@ -484,4 +484,5 @@ from waitress import serve
 
 
 if __name__ == "__main__":
-    serve(app, host="0.0.0.0", port=5167, threads=200)
+    # recv_bytes: read request bodies (photo/file uploads) in 64 KiB socket reads instead of 8 KiB
+    serve(app, host="0.0.0.0", port=5167, threads=200, recv_bytes=65536)
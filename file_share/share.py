@@ -1,8 +1,22 @@
 import os
+import atexit
+import hashlib
+import heapq
+import hmac
 import io
+import json
 import mimetypes
 import shutil
+import socket
+import sqlite3
+import stat
 import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 import logging
@@ -18,7 +32,29 @@ from flask import (
     render_template,
     current_app,
 )
-from functools import wraps
+from functools import lru_cache, wraps
+from urllib.parse import quote
+from werkzeug.utils import send_file as _wz_send_file
+
+try:
+    import orjson
+except ImportError:  # optional speed-up; stdlib json keeps working without it
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # without msgpack, folder meta stays in .meta.json
+    msgpack = None
+
+
+def _json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _json_dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
 
 
 share_bp = Blueprint(
@@ -39,10 +75,13 @@ def login_required(f):
     return decorated_function
 
 
+@lru_cache(maxsize=1)
 def _tz_tw():
     return timezone(timedelta(hours=8))
 
 
+# Env-derived settings are fixed for the process lifetime; resolve them once.
+@lru_cache(maxsize=1)
 def _get_storage_root() -> Path:
     root = os.getenv("STORAGE_ROOT")
     if not root:
@@ -53,6 +92,7 @@ def _get_storage_root() -> Path:
     return p
 
 
+@lru_cache(maxsize=1)
 def _get_preview_cache_root() -> Path:
     # cache folder for converted previews (PDF/images)
     root = _get_storage_root() / ".previews"
@@ -80,25 +120,66 @@ def _safe_join(base: Path, *paths: str) -> Path:
     return resolved
 
 
-def _allowed_ext_set() -> set:
+@lru_cache(maxsize=1)
+def _allowed_ext_set() -> frozenset:
     exts = os.getenv(
         "SHARE_ALLOWED_EXT",
         "pdf,docx,xlsx,jpg,png,mp4,mov,avi",
     )
-    return set(e.strip().lower() for e in exts.split(",") if e.strip())
+    return frozenset(e.strip().lower() for e in exts.split(",") if e.strip())
 
 
+@lru_cache(maxsize=1)
 def _max_file_size_bytes() -> int:
     # Default 200MB
     mb = int(os.getenv("SHARE_MAX_FILE_MB", "200"))
     return mb * 1024 * 1024
 
 
-def _is_admin() -> bool:
+@lru_cache(maxsize=1)
+def _max_request_size_bytes() -> int:
+    # Whole upload request (several files); default 2GB
+    mb = int(os.getenv("SHARE_MAX_REQUEST_MB", "2048"))
+    return mb * 1024 * 1024
+
+
+_COPY_CHUNK = 1024 * 1024
+
+
+def _save_upload(stream, dest: Path, max_bytes: int) -> int | None:
+    """Copy an upload stream to dest in 1 MiB chunks.
+
+    Writes to a temp file first so an oversized upload never clobbers an
+    existing file. Returns bytes written, or None if max_bytes was exceeded.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=_get_preview_cache_root(), suffix=".part")
+    written = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(_COPY_CHUNK)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    return None
+                out.write(chunk)
+        os.replace(tmp_name, dest)
+        return written
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
+
+@lru_cache(maxsize=1)
+def _admin_users() -> frozenset:
     # Admin users from env var (comma separated), default to C4D002 for parity with inventory admin
     admins = os.getenv("SHARE_ADMIN_USERS", "C4D002")
-    admin_set = {u.strip() for u in admins.split(",") if u.strip()}
-    return (session.get("username") or "") in admin_set
+    return frozenset(u.strip() for u in admins.split(",") if u.strip())
+
+
+def _is_admin() -> bool:
+    return (session.get("username") or "") in _admin_users()
 
 
 @share_bp.route("/share")
@@ -113,6 +194,7 @@ def share_page():
     )
 
 
+@lru_cache(maxsize=1)
 def _ensure_libreoffice_path() -> str | None:
     # Try env path first, then common locations on Windows, else typical command name
     env_path = os.getenv("LIBREOFFICE_PATH")
@@ -132,31 +214,370 @@ def _ensure_libreoffice_path() -> str | None:
     return "soffice"
 
 
+# Cap concurrent LibreOffice conversions; LO misbehaves under many parallel jobs
+_LO_SEMAPHORE = threading.BoundedSemaphore(max(1, int(os.getenv("SHARE_LO_WORKERS", "2"))))
+_UNO_LOCK = threading.Lock()
+_UNO_PROC: subprocess.Popen | None = None
+_UNO_DISABLED = os.getenv("SHARE_UNO_DAEMON", "1") == "0"
+# Consecutive failed starts and when the next start may be attempted (monotonic)
+_UNO_FAILURES = 0
+_UNO_RETRY_AT = 0.0
+_UNO_MAX_BACKOFF = 300
+
+
+@atexit.register
+def _stop_uno_server():
+    """Terminate the unoserver this worker started, so recycled workers don't leak it."""
+    proc = _UNO_PROC
+    if proc is None or proc.poll() is not None:
+        return
+    try:
+        proc.terminate()
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    except OSError:
+        pass
+
+
+def _uno_start_failed(port: int):
+    """Record a failed start and back off exponentially before the next attempt."""
+    global _UNO_PROC, _UNO_FAILURES, _UNO_RETRY_AT
+    if _UNO_PROC is not None and _UNO_PROC.poll() is None:
+        _UNO_PROC.kill()
+    _UNO_PROC = None
+    _UNO_FAILURES += 1
+    delay = min(_UNO_MAX_BACKOFF, 5 * 2 ** (_UNO_FAILURES - 1))
+    _UNO_RETRY_AT = time.monotonic() + delay
+    logging.error("unoserver not ready on port %s (failure %s), retrying in %ss", port, _UNO_FAILURES, delay)
+
+
+def _uno_port() -> int:
+    return int(os.getenv("SHARE_UNO_PORT", "2003"))
+
+
+def _port_open(port: int) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def _ensure_uno_server() -> bool:
+    """Make sure a long-lived unoserver (LibreOffice listening on a socket) is up.
+
+    Started lazily on the first preview and restarted if it dies. If another
+    process already serves the port it is reused. Returns False when unoserver
+    is not installed, or while backing off after failed starts, so callers can
+    fall back to a one-shot soffice run.
+    """
+    global _UNO_PROC, _UNO_DISABLED, _UNO_FAILURES
+    if _UNO_DISABLED:
+        return False
+    with _UNO_LOCK:
+        port = _uno_port()
+        if _UNO_PROC is not None and _UNO_PROC.poll() is not None:
+            logging.warning("unoserver exited rc=%s, restarting", _UNO_PROC.returncode)
+            _UNO_PROC = None
+        if _port_open(port):
+            _UNO_FAILURES = 0
+            return True
+        if _UNO_PROC is None and time.monotonic() < _UNO_RETRY_AT:
+            return False
+        if _UNO_PROC is None:
+            cmd = [
+                os.getenv("UNOSERVER_PATH", "unoserver"),
+                "--interface",
+                "127.0.0.1",
+                "--port",
+                str(port),
+                "--uno-port",
+                os.getenv("SHARE_LO_UNO_PORT", "2002"),
+            ]
+            soffice = _ensure_libreoffice_path()
+            if soffice:
+                cmd += ["--executable", soffice]
+            try:
+                _UNO_PROC = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logging.warning("unoserver unavailable, using one-shot soffice conversions: %s", e)
+                _UNO_DISABLED = True
+                return False
+        # Health-check: wait until the daemon accepts connections
+        deadline = time.monotonic() + int(os.getenv("SHARE_UNO_START_TIMEOUT", "30"))
+        while time.monotonic() < deadline:
+            if _port_open(port):
+                _UNO_FAILURES = 0
+                return True
+            if _UNO_PROC.poll() is not None:
+                break
+            time.sleep(0.25)
+        _uno_start_failed(port)
+        return False
+
+
+def _uno_convert(src: Path, dest_pdf: Path, timeout_s: int) -> bool:
+    """Convert through the shared unoserver daemon. Returns True on success."""
+    if not _ensure_uno_server():
+        return False
+    cmd = [
+        os.getenv("UNOCONVERT_PATH", "unoconvert"),
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(_uno_port()),
+        "--convert-to",
+        "pdf",
+        str(src),
+        str(dest_pdf),
+    ]
+    try:
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout_s,
+            check=False,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.error("unoconvert failed: %s", e)
+        return False
+    if result.returncode == 0 and dest_pdf.exists():
+        return True
+    logging.error(
+        "unoconvert failed rc=%s stderr=%s cmd=%s",
+        result.returncode,
+        result.stderr.decode(errors="ignore"),
+        cmd,
+    )
+    return False
+
+
+# abs path -> (mtime, size, sha256) so unchanged files are not re-hashed
+class _LRUCache:
+    """Thread-safe mapping that keeps only the maxsize most recently used keys."""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = max(1, maxsize)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def __len__(self):
+        return len(self._data)
+
+
+_HASH_CACHE = _LRUCache(int(os.getenv("SHARE_HASH_CACHE_SIZE", "4096")))
+
+
+def _file_sha256(path: Path) -> str:
+    st = path.stat()
+    key = str(path)
+    cached = _HASH_CACHE.get(key)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+    with path.open("rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    _HASH_CACHE[key] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+
+def _pdf_path_for_digest(digest: str) -> Path:
+    return _get_preview_cache_root() / "by-hash" / digest[:2] / f"{digest}.pdf"
+
+
+def _preview_pdf_path(src: Path) -> Path:
+    # Location of the cached PDF for src (may not exist yet)
+    return _pdf_path_for_digest(_file_sha256(src))
+
+
+def _known_preview_pdf_path(src: Path) -> Path | None:
+    """Cached PDF location when src's hash is already known in this process; never hashes."""
+    st = src.stat()
+    cached = _HASH_CACHE.get(str(src))
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return _pdf_path_for_digest(cached[2])
+    return None
+
+
 def _convert_office_to_pdf(src: Path) -> Path | None:
     """Convert Office file to PDF using LibreOffice headless. Returns PDF path or None.
 
+    Converted PDFs are cached by content hash under .previews/by-hash, so renamed,
+    moved or re-uploaded copies of the same file reuse one conversion.
     Detailed stdout/stderr are logged on failure for diagnostics.
     """
+    dest_pdf = _preview_pdf_path(src)
+    out_dir = dest_pdf.parent
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if dest_pdf.exists():
+        return dest_pdf
+
+    timeout_s = int(os.getenv("SHARE_CONVERT_TIMEOUT", "180"))
+    with _LO_SEMAPHORE:
+        # Another request may have converted the same content while we waited
+        if dest_pdf.exists():
+            return dest_pdf
+        # Convert into a private work dir, then move into place atomically
+        work_dir = Path(tempfile.mkdtemp(dir=out_dir))
+        try:
+            tmp_pdf = work_dir / src.with_suffix(".pdf").name
+            # Preferred path: reuse the warm LibreOffice behind unoserver
+            if _uno_convert(src, tmp_pdf, timeout_s) or _soffice_convert(src, work_dir, tmp_pdf, timeout_s):
+                os.replace(tmp_pdf, dest_pdf)
+                return dest_pdf
+            return None
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Background Office->PDF conversions so request threads are not held for seconds
+_PREVIEW_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv("SHARE_PREVIEW_WORKERS", "2"))),
+    thread_name_prefix="share-preview",
+)
+_PREVIEW_LOCK = threading.Lock()
+# job id -> (abs source path, future, submitted at, (mtime_ns, size) of the source when submitted)
+_PREVIEW_JOBS: dict[str, tuple[str, Future, float, tuple[int, int]]] = {}
+_PREVIEW_JOB_BY_SRC: dict[str, str] = {}  # abs source path -> job id
+_PREVIEW_JOB_TTL = 600
+
+# Job status is kept in SQLite so a poll answered by another FastCGI worker still finds it
+_PREVIEW_DB_READY = False
+
+
+def _preview_jobs_conn() -> sqlite3.Connection:
+    global _PREVIEW_DB_READY
+    conn = sqlite3.connect(str(_get_preview_cache_root() / "preview_jobs.db"), timeout=10)
+    if not _PREVIEW_DB_READY:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS preview_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                pdf_path TEXT,
+                submitted_at REAL NOT NULL,
+                finished_at REAL
+            )
+            """
+        )
+        conn.commit()
+        _PREVIEW_DB_READY = True
+    return conn
+
+
+def _set_preview_job(job_id: str, status: str, pdf_path: str | None = None):
+    conn = _preview_jobs_conn()
     try:
-        out_dir = _get_preview_cache_root() / src.parent.relative_to(_get_storage_root())
-        out_dir.mkdir(parents=True, exist_ok=True)
-    except Exception:
-        out_dir = _get_preview_cache_root()
-        out_dir.mkdir(parents=True, exist_ok=True)
+        with conn:
+            if status == "pending":
+                now = time.time()
+                # Rows outlive the in-memory registry so a reused job id always resolves
+                conn.execute("DELETE FROM preview_jobs WHERE submitted_at < ?", (now - 2 * _PREVIEW_JOB_TTL,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO preview_jobs (job_id, status, submitted_at) VALUES (?, 'pending', ?)",
+                    (job_id, now),
+                )
+            else:
+                conn.execute(
+                    "UPDATE preview_jobs SET status = ?, pdf_path = ?, finished_at = ? WHERE job_id = ?",
+                    (status, pdf_path, time.time(), job_id),
+                )
+    finally:
+        conn.close()
 
-    pdf_name = src.with_suffix(".pdf").name
-    dest_pdf = out_dir / pdf_name
-    # If cached and newer than source, reuse
-    if dest_pdf.exists() and dest_pdf.stat().st_mtime >= src.stat().st_mtime:
-        return dest_pdf
 
+def _get_preview_job(job_id: str) -> tuple[str, str | None, float] | None:
+    conn = _preview_jobs_conn()
+    try:
+        return conn.execute(
+            "SELECT status, pdf_path, submitted_at FROM preview_jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def _run_preview_job(job_id: str, src: Path) -> Path | None:
+    """Background job: hash + convert src, then record the outcome for any worker to read."""
+    pdf = None
+    try:
+        pdf = _convert_office_to_pdf(src)
+    except Exception as e:
+        logging.exception("share.preview conversion error: %s", e)
+    try:
+        if pdf and pdf.exists():
+            _set_preview_job(job_id, "done", str(pdf))
+        else:
+            _set_preview_job(job_id, "failed")
+    except sqlite3.Error as e:
+        logging.exception("share.preview job status update failed job=%s: %s", job_id, e)
+    return pdf
+
+
+def _submit_preview(src: Path) -> str:
+    """Queue a conversion for src and return its job id, reusing a pending or successful job.
+
+    A job is only reused while the source still has the (mtime, size) it was
+    submitted with, so an overwritten file gets a fresh conversion.
+    """
+    key = str(src)
+    st = src.stat()
+    sig = (st.st_mtime_ns, st.st_size)
+    now = time.monotonic()
+    with _PREVIEW_LOCK:
+        # Forget finished jobs after a while so the registry stays small
+        for job_id, (src_key, fut, submitted_at, _) in list(_PREVIEW_JOBS.items()):
+            if fut.done() and now - submitted_at > _PREVIEW_JOB_TTL:
+                _PREVIEW_JOBS.pop(job_id, None)
+                if _PREVIEW_JOB_BY_SRC.get(src_key) == job_id:
+                    _PREVIEW_JOB_BY_SRC.pop(src_key, None)
+        job_id = _PREVIEW_JOB_BY_SRC.get(key)
+        if job_id in _PREVIEW_JOBS:
+            _, fut, _, job_sig = _PREVIEW_JOBS[job_id]
+            if job_sig != sig:
+                # Source changed since that job: its PDF is for the old content
+                _PREVIEW_JOB_BY_SRC.pop(key, None)
+                if fut.done():
+                    _PREVIEW_JOBS.pop(job_id, None)
+            # Retry only when the previous attempt failed
+            elif not fut.done() or (fut.exception() is None and fut.result() is not None):
+                return job_id
+        job_id = uuid.uuid4().hex
+        _set_preview_job(job_id, "pending")
+        _PREVIEW_JOBS[job_id] = (key, _PREVIEW_EXECUTOR.submit(_run_preview_job, job_id, src), now, sig)
+        _PREVIEW_JOB_BY_SRC[key] = job_id
+        return job_id
+
+
+def _soffice_convert(src: Path, out_dir: Path, dest_pdf: Path, timeout_s: int) -> Path | None:
+    """One-shot `soffice --convert-to pdf` run (cold LibreOffice start per file)."""
     soffice = _ensure_libreoffice_path()
     if not soffice:
         return None
 
     try:
         # Run conversion; set cwd to src directory to avoid some LO path quirks
-        timeout_s = int(os.getenv("SHARE_CONVERT_TIMEOUT", "180"))
         cmd = [
             soffice,
             "--headless",
@@ -203,14 +624,20 @@ def _display_time_zh(ts: float) -> str:
     return dt.strftime("%Y年%m月%d日 %H:%M:%S")
 
 
-def _load_meta(dir_path: Path) -> dict:
-    meta_file = dir_path / ".meta.json"
+_META_JSON = ".meta.json"
+_META_MP = ".meta.mp"
+# Internal bookkeeping entries hidden from listings and search
+_INTERNAL_NAMES = {".previews", _META_JSON, _META_MP, _META_JSON + ".tmp", _META_MP + ".tmp"}
+
+
+def _load_meta_raw(meta_file: Path) -> dict:
     if meta_file.exists():
         try:
-            import json
-
-            with meta_file.open("r", encoding="utf-8") as f:
-                data = json.load(f)
+            raw = meta_file.read_bytes()
+            if meta_file.name == _META_MP:
+                data = msgpack.unpackb(raw, raw=False)
+            else:
+                data = _json_loads(raw)
             if isinstance(data, dict):
                 data.setdefault("files", {})
                 return data
@@ -219,201 +646,526 @@ def _load_meta(dir_path: Path) -> dict:
     return {"files": {}}
 
 
-def _save_meta(dir_path: Path, data: dict):
-    try:
-        import json
+# meta file path -> (mtime_ns, parsed meta); re-read only when the file changes
+_META_CACHE = _LRUCache(int(os.getenv("SHARE_META_CACHE_SIZE", "1024")))
+
+
+# Coalesced meta writes: dir path -> (dir, data) waiting to be flushed.
+# _META_LOCK also guards the load-mutate-save sequences in _update_meta_on_*.
+_META_LOCK = threading.RLock()
+_META_DIRTY: dict[str, tuple[Path, dict]] = {}
+_META_FLUSH_TIMER: threading.Timer | None = None
+_META_FLUSH_DELAY = 0.1
+
+
+def _load_meta(dir_path: Path) -> dict:
+    # Unflushed changes win over whatever is on disk
+    pending = _META_DIRTY.get(str(dir_path))
+    if pending is not None:
+        return pending[1]
+    # Prefer the MessagePack sidecar; fall back to legacy .meta.json
+    names = (_META_MP, _META_JSON) if msgpack is not None else (_META_JSON,)
+    for name in names:
+        meta_file = dir_path / name
+        try:
+            mtime_ns = meta_file.stat().st_mtime_ns
+        except OSError:
+            continue
+        key = str(meta_file)
+        cached = _META_CACHE.get(key)
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+        data = _load_meta_raw(meta_file)
+        _META_CACHE[key] = (mtime_ns, data)
+        return data
+    return {"files": {}}
+
+
+# Cleared after the first failure so we don't retry O_TMPFILE on every write
+_USE_O_TMPFILE = hasattr(os, "O_TMPFILE")
+
 
-        meta_file = dir_path / ".meta.json"
-        tmp = meta_file.with_suffix(".json.tmp")
-        with tmp.open("w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False)
-        tmp.replace(meta_file)
+def _atomic_write(target: Path, payload: bytes):
+    """Replace target with payload atomically.
+
+    On Linux the data is written to an anonymous O_TMPFILE inode and only
+    linked into the directory once complete, so a crash never leaves a
+    half-written temp file behind. Elsewhere (or if linking is refused) it
+    falls back to write + rename.
+    """
+    global _USE_O_TMPFILE
+    tmp = target.with_name(target.name + ".tmp")
+    if _USE_O_TMPFILE:
+        try:
+            fd = os.open(str(target.parent), os.O_TMPFILE | os.O_WRONLY, 0o644)
+        except OSError:
+            fd = None  # filesystem without O_TMPFILE support
+        if fd is not None:
+            try:
+                view = memoryview(payload)
+                while view:
+                    view = view[os.write(fd, view):]
+                # linkat cannot overwrite, so link under the temp name and rename over target
+                tmp.unlink(missing_ok=True)
+                os.link(f"/proc/self/fd/{fd}", str(tmp))
+                os.replace(tmp, target)
+                return
+            except OSError as e:
+                logging.info("O_TMPFILE write unavailable (%s), using temp file + rename", e)
+                _USE_O_TMPFILE = False
+            finally:
+                os.close(fd)
+    tmp.write_bytes(payload)
+    tmp.replace(target)
+
+
+def _write_meta(dir_path: Path, data: dict):
+    name = _META_MP if msgpack is not None else _META_JSON
+    meta_file = dir_path / name
+    try:
+        if msgpack is not None:
+            payload = msgpack.packb(data, use_bin_type=True)
+        else:
+            payload = _json_dumps(data)
+        _atomic_write(meta_file, payload)
+        _META_CACHE[str(meta_file)] = (meta_file.stat().st_mtime_ns, data)
+        if msgpack is not None:
+            # Migrated: drop the legacy JSON so it can't shadow newer data
+            legacy = dir_path / _META_JSON
+            if legacy.exists():
+                legacy.unlink()
+            _META_CACHE.pop(str(legacy), None)
     except Exception:
-        pass
+        # callers mutate the cached dict in place; drop it if the write failed
+        _META_CACHE.pop(str(meta_file), None)
+
+
+def _save_meta(dir_path: Path, data: dict):
+    """Queue a meta write; bursts (e.g. a 100-file upload) collapse into one write."""
+    global _META_FLUSH_TIMER
+    with _META_LOCK:
+        _META_DIRTY[str(dir_path)] = (dir_path, data)
+        if _META_FLUSH_TIMER is None:
+            _META_FLUSH_TIMER = threading.Timer(_META_FLUSH_DELAY, _flush_meta)
+            _META_FLUSH_TIMER.daemon = True
+            _META_FLUSH_TIMER.start()
+
+
+def _flush_meta(dir_path: Path | None = None):
+    """Write pending meta for one directory, or for all of them when dir_path is None."""
+    global _META_FLUSH_TIMER
+    with _META_LOCK:
+        if dir_path is None:
+            pending = list(_META_DIRTY.values())
+            _META_DIRTY.clear()
+            _META_FLUSH_TIMER = None
+        else:
+            item = _META_DIRTY.pop(str(dir_path), None)
+            pending = [item] if item else []
+        for path, data in pending:
+            _write_meta(path, data)
+
+
+atexit.register(_flush_meta)
 
 
 def _update_meta_on_upload(dir_path: Path, filename: str, uploader: str, uploader_name: str | None = None):
-    data = _load_meta(dir_path)
-    files = data.setdefault("files", {})
-    files[filename] = {
-        "uploader": uploader,
-        "uploader_username": uploader,
-        "uploader_name": uploader_name or "",
-        "uploaded_at": datetime.now(tz=_tz_tw()).isoformat(),
-    }
-    _save_meta(dir_path, data)
-
-
-def _update_meta_on_delete(dir_path: Path, name: str):
-    data = _load_meta(dir_path)
-    files = data.setdefault("files", {})
-    if name in files:
-        files.pop(name, None)
+    with _META_LOCK:
+        data = _load_meta(dir_path)
+        files = data.setdefault("files", {})
+        files[filename] = {
+            "uploader": uploader,
+            "uploader_username": uploader,
+            "uploader_name": uploader_name or "",
+            "uploaded_at": datetime.now(tz=_tz_tw()).isoformat(),
+        }
         _save_meta(dir_path, data)
 
 
-def _update_meta_on_rename(dir_path: Path, old: str, new: str):
-    data = _load_meta(dir_path)
-    files = data.setdefault("files", {})
-    if old in files:
-        files[new] = files.pop(old)
-        _save_meta(dir_path, data)
+def _update_meta_on_delete(dir_path: Path, name: str, meta: dict | None = None):
+    with _META_LOCK:
+        data = meta if meta is not None else _load_meta(dir_path)
+        files = data.setdefault("files", {})
+        if name in files:
+            files.pop(name, None)
+            _save_meta(dir_path, data)
+
+
+def _update_meta_on_rename(dir_path: Path, old: str, new: str, meta: dict | None = None):
+    with _META_LOCK:
+        data = meta if meta is not None else _load_meta(dir_path)
+        files = data.setdefault("files", {})
+        if old in files:
+            files[new] = files.pop(old)
+            _save_meta(dir_path, data)
+
+
+def _get_uploader_for(dir_path: Path, name: str, meta: dict | None = None) -> str | None:
+    data = meta if meta is not None else _load_meta(dir_path)
+    fmeta = (data.get("files", {}).get(name, {}) or {})
+    return fmeta.get("uploader_username") or fmeta.get("uploader")
+
+
+def _split_ext(name: str) -> tuple[str, str]:
+    """Split ``name`` into (stem, ext) with the same rules as ``Path.stem``/``Path.suffix``."""
+    stem, dot, ext = name.rpartition(".")
+    if not dot or not stem or not ext:
+        return name, ""
+    return stem, ext
+
+
+def _scan(base: Path):
+    """Depth-first walk under ``base`` yielding (rel_dir, DirEntry).
+
+    Uses os.scandir so file type and stat info come from the directory read
+    itself; internal preview cache and meta files are pruned here.
+    """
+    stack = [(str(base), "")]
+    while stack:
+        cur, rel = stack.pop()
+        try:
+            with os.scandir(cur) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for e in entries:
+            if e.name.lower() in _INTERNAL_NAMES:
+                continue
+            yield rel, e
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append((e.path, f"{rel}/{e.name}" if rel else e.name))
+            except OSError:
+                pass
+
+
+_INDEX_LOCK = threading.Lock()
+_INDEX_CONN: sqlite3.Connection | None = None
+
+
+def _rel_of(path: Path) -> str:
+    # posix path relative to storage root, "" for the root itself
+    rel = path.relative_to(_get_storage_root()).as_posix()
+    return "" if rel == "." else rel
+
+
+def _index_row(parent: str, name: str, is_dir: bool, size: int, mtime: float, uploader: str = "", uploader_name: str = ""):
+    stem, ext = ("", "") if is_dir else _split_ext(name)
+    search_key = name.lower() if is_dir else stem.lower()
+    return (parent, name, int(is_dir), size, mtime, ext.lower(), search_key, uploader, uploader_name)
+
+
+def _scan_index_rows(root: Path) -> list[tuple]:
+    """Index rows for every entry currently on disk under root."""
+    rows = []
+    meta_cache: dict[str, dict] = {}
+    for rel, entry in _scan(root):
+        try:
+            st = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                rows.append(_index_row(rel, entry.name, True, 0, st.st_mtime))
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            meta = meta_cache.get(rel)
+            if meta is None:
+                meta = _load_meta(Path(entry.path).parent)
+                meta_cache[rel] = meta
+            fmeta = (meta.get("files", {}).get(entry.name, {}) or {})
+            uploader = fmeta.get("uploader_username") or fmeta.get("uploader", "")
+            rows.append(
+                _index_row(rel, entry.name, False, st.st_size, st.st_mtime, uploader, fmeta.get("uploader_name") or "")
+            )
+        except OSError:
+            continue
+    return rows
+
+
+def _backfill_index(conn: sqlite3.Connection, root: Path):
+    """Populate the index from a one-off scan of the whole storage tree."""
+    rows = _scan_index_rows(root)
+    with conn:
+        conn.execute("DELETE FROM entries")
+        conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO index_state (key, value) VALUES ('built_at', ?)", (datetime.now(tz=_tz_tw()).isoformat(),))
+    logging.info("share.index backfilled %s entries", len(rows))
+
+
+# Skip the start-up re-sync when another worker finished one this recently
+_INDEX_RESYNC_MIN_AGE = int(os.getenv("SHARE_INDEX_RESYNC_MIN_AGE", "60"))
+
+
+def _resync_index(db_path: Path, root: Path):
+    """Reconcile an existing index with the storage tree.
+
+    Picks up files added, changed or removed outside the app. Runs on its own
+    connection in a background thread; rows the app wrote after the scan started
+    are left alone so concurrent uploads are not dropped.
+    """
+    try:
+        scan_started = time.time()
+        rows = _scan_index_rows(root)
+        conn = sqlite3.connect(str(db_path), timeout=30)
+        try:
+            with conn:
+                conn.execute("CREATE TEMP TABLE seen (parent_path TEXT, name TEXT, PRIMARY KEY (parent_path, name))")
+                conn.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?)", ((r[0], r[1]) for r in rows))
+                conn.execute(
+                    """
+                    DELETE FROM entries
+                    WHERE mtime < ?
+                      AND NOT EXISTS (SELECT 1 FROM seen s WHERE s.parent_path = entries.parent_path AND s.name = entries.name)
+                    """,
+                    (scan_started,),
+                )
+                conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.execute("INSERT OR REPLACE INTO index_state (key, value) VALUES ('built_at', ?)", (datetime.now(tz=_tz_tw()).isoformat(),))
+        finally:
+            conn.close()
+        logging.info("share.index re-synced %s entries", len(rows))
+    except Exception as e:
+        logging.exception("share.index re-sync failed: %s", e)
+
+
+def _index_age_seconds(built_at: str) -> float:
+    try:
+        return (datetime.now(tz=_tz_tw()) - datetime.fromisoformat(built_at)).total_seconds()
+    except (TypeError, ValueError):
+        return float("inf")
+
+
+def _get_index_conn() -> sqlite3.Connection:
+    """Per-process connection to the keyword-search index.
+
+    The index lives in the preview cache folder so it never shows up in listings.
+    It is backfilled from disk the first time it is created, and re-synced in the
+    background once per process start so files changed outside the app are found.
+    """
+    global _INDEX_CONN
+    if _INDEX_CONN is None:
+        with _INDEX_LOCK:
+            if _INDEX_CONN is None:
+                db_path = _get_preview_cache_root() / "share_index.db"
+                conn = sqlite3.connect(str(db_path), check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS entries (
+                        parent_path TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        is_dir INTEGER NOT NULL,
+                        size INTEGER NOT NULL DEFAULT 0,
+                        mtime REAL NOT NULL DEFAULT 0,
+                        ext TEXT NOT NULL DEFAULT '',
+                        search_key TEXT NOT NULL,
+                        uploader TEXT NOT NULL DEFAULT '',
+                        uploader_name TEXT NOT NULL DEFAULT '',
+                        PRIMARY KEY (parent_path, name)
+                    )
+                    """
+                )
+                # Search matches substrings with instr(), which no B-tree index can serve
+                conn.execute("DROP INDEX IF EXISTS idx_entries_name")
+                conn.execute("CREATE TABLE IF NOT EXISTS index_state (key TEXT PRIMARY KEY, value TEXT)")
+                built = conn.execute("SELECT value FROM index_state WHERE key = 'built_at'").fetchone()
+                if built is None:
+                    _backfill_index(conn, _get_storage_root())
+                elif _index_age_seconds(built[0]) >= _INDEX_RESYNC_MIN_AGE:
+                    threading.Thread(
+                        target=_resync_index,
+                        args=(db_path, _get_storage_root()),
+                        name="share-index-resync",
+                        daemon=True,
+                    ).start()
+                _INDEX_CONN = conn
+    return _INDEX_CONN
+
+
+def _index_upsert(path: Path, uploader: str = "", uploader_name: str = ""):
+    # Best-effort: the filesystem stays the source of truth
+    try:
+        st = path.stat()
+        is_dir = path.is_dir()
+        row = _index_row(_rel_of(path.parent), path.name, is_dir, 0 if is_dir else st.st_size, st.st_mtime, uploader, uploader_name)
+        conn = _get_index_conn()
+        with _INDEX_LOCK, conn:
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+    except Exception as e:
+        logging.exception("share.index upsert failed path=%s: %s", path, e)
+
+
+def _index_remove(path: Path):
+    try:
+        rel = _rel_of(path)
+        conn = _get_index_conn()
+        with _INDEX_LOCK, conn:
+            conn.execute("DELETE FROM entries WHERE parent_path = ? AND name = ?", (_rel_of(path.parent), path.name))
+            conn.execute(
+                "DELETE FROM entries WHERE parent_path = ? OR substr(parent_path, 1, ?) = ?",
+                (rel, len(rel) + 1, rel + "/"),
+            )
+    except Exception as e:
+        logging.exception("share.index remove failed path=%s: %s", path, e)
+
 
+def _index_rename(src: Path, dst: Path):
+    try:
+        old_rel, new_rel = _rel_of(src), _rel_of(dst)
+        conn = _get_index_conn()
+        with _INDEX_LOCK, conn:
+            row = conn.execute(
+                "SELECT is_dir, size, mtime, uploader, uploader_name FROM entries WHERE parent_path = ? AND name = ?",
+                (_rel_of(src.parent), src.name),
+            ).fetchone()
+            conn.execute("DELETE FROM entries WHERE parent_path = ? AND name = ?", (_rel_of(src.parent), src.name))
+            if row is not None:
+                is_dir, size, mtime, uploader, uploader_name = row
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    _index_row(_rel_of(dst.parent), dst.name, bool(is_dir), size, mtime, uploader, uploader_name),
+                )
+            # Re-parent descendants of a renamed directory
+            conn.execute(
+                "UPDATE entries SET parent_path = ? || substr(parent_path, ?) WHERE parent_path = ? OR substr(parent_path, 1, ?) = ?",
+                (new_rel, len(old_rel) + 1, old_rel, len(old_rel) + 1, old_rel + "/"),
+            )
+    except Exception as e:
+        logging.exception("share.index rename failed src=%s dst=%s: %s", src, dst, e)
 
-def _get_uploader_for(dir_path: Path, name: str) -> str | None:
-    data = _load_meta(dir_path)
-    meta = (data.get("files", {}).get(name, {}) or {})
-    return meta.get("uploader_username") or meta.get("uploader")
 
+_INDEX_READERS = threading.local()
 
-def _list_dir(root: Path, rel_dir: str | None, keyword: str | None):
+
+def _get_index_reader() -> sqlite3.Connection:
+    """Per-thread read-only connection for searches.
+
+    The index is in WAL mode, so readers never block (or get blocked by) the
+    writer connection and searches do not need _INDEX_LOCK.
+    """
+    conn = getattr(_INDEX_READERS, "conn", None)
+    if conn is None:
+        _get_index_conn()  # make sure the index exists and is backfilled
+        db_path = _get_preview_cache_root() / "share_index.db"
+        conn = sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True)
+        _INDEX_READERS.conn = conn
+    return conn
+
+
+def _search_index(base: Path, keyword_l: str):
+    """Yield keyword matches under base straight from the index cursor."""
+    base_rel = _rel_of(base)
+    conn = _get_index_reader()
+    cur = conn.execute(
+        """
+        SELECT parent_path, name, is_dir, size, mtime, ext, uploader, uploader_name
+        FROM entries
+        WHERE instr(search_key, ?) > 0
+          AND (? = '' OR parent_path = ? OR substr(parent_path, 1, ?) = ?)
+        """,
+        (keyword_l, base_rel, base_rel, len(base_rel) + 1, base_rel + "/"),
+    )
+    for parent, name, is_dir, size, mtime, ext, uploader, uploader_name in cur:
+        yield {
+            "name": name,
+            "type": ext,
+            "size": size,
+            "_mtime": mtime,
+            "is_dir": bool(is_dir),
+            "rel_path": f"{parent}/{name}" if parent else name,
+            "uploader": uploader,
+            "uploader_name": uploader_name,
+        }
+
+
+def _iter_items(root: Path, rel_dir: str | None, keyword: str | None):
+    """Yield listing items lazily so callers never need to hold every match."""
     base = _safe_join(root, rel_dir or "")
     if not base.exists() or not base.is_dir():
-        return [], 0
+        return
     keyword_l = (keyword or "").lower().strip()
+    prefix = Path(rel_dir or "").as_posix()
+    prefix = "" if prefix == "." else prefix + "/"
 
-    items = []
-    # If keyword provided, include matches in subdirectories as well
+    # If keyword provided, include matches in subdirectories as well (served from the index)
     if keyword_l:
-        # Cache meta per directory to avoid repeated file I/O
-        meta_cache: dict[str, dict] = {}
-        for dirpath, dirnames, filenames in os.walk(base):
-            # skip internal preview cache directories
-            dirnames[:] = [d for d in dirnames if d.lower() != ".previews"]
-            cur_dir = Path(dirpath)
-            rel_path_from_base = (
-                (Path(rel_dir or "") / cur_dir.relative_to(base)).as_posix()
-                if cur_dir != base
-                else Path(rel_dir or "").as_posix()
-            )
-            # Directories match
-            for d in dirnames:
-                if d.lower() == ".previews":
-                    continue
-                if keyword_l in d.lower():
-                    p = cur_dir / d
-                    try:
-                        mtime = p.stat().st_mtime
-                        items.append(
-                            {
-                                "name": d,
-                                "type": "",
-                                "size": 0,
-                                "modified_at": _iso8601_tw(mtime),
-                                "modified_at_display": _display_time_zh(mtime),
-                                "is_dir": True,
-                                "rel_path": (Path(rel_path_from_base) / d).as_posix(),
-                                "uploader": "",
-                                "uploader_name": "",
-                            }
-                        )
-                    except Exception:
-                        pass
-            # Files match
-            # Load meta once per directory
-            meta = meta_cache.get(dirpath)
-            if meta is None:
-                meta = _load_meta(cur_dir)
-                meta_cache[dirpath] = meta
-            for f in filenames:
-                if f.lower() == ".meta.json":
-                    continue
-                # Search only by base filename (exclude extension)
-                base_name = Path(f).stem.lower()
-                if keyword_l in base_name:
-                    p = cur_dir / f
-                    try:
-                        stat = p.stat()
-                        ext = p.suffix[1:].lower()
-                        fmeta = (meta.get("files", {}).get(f, {}) or {})
-                        uploader = fmeta.get("uploader_username") or fmeta.get("uploader", "")
-                        uploader_name = fmeta.get("uploader_name") or ""
-                        items.append(
-                            {
-                                "name": f,
-                                "type": ext,
-                                "size": stat.st_size,
-                                "modified_at": _iso8601_tw(stat.st_mtime),
-                                "modified_at_display": _display_time_zh(stat.st_mtime),
-                                "is_dir": False,
-                                "rel_path": (Path(rel_path_from_base) / f).as_posix(),
-                                "uploader": uploader,
-                                "uploader_name": uploader_name,
-                            }
-                        )
-                    except Exception:
-                        pass
-    else:
-        # Non-recursive listing in current directory
-        meta = _load_meta(base)
-        for entry in base.iterdir():
+        yield from _search_index(base, keyword_l)
+        return
+
+    # Non-recursive listing in current directory
+    meta = _load_meta(base)
+    with os.scandir(base) as it:
+        for entry in it:
             try:
                 name = entry.name
-                if name.lower() == ".meta.json" or name.lower() == ".previews":
+                if name.lower() in _INTERNAL_NAMES:
                     continue
-                is_dir = entry.is_dir()
-                size = entry.stat().st_size if entry.is_file() else 0
-                mtime = entry.stat().st_mtime
-                ext = (entry.suffix[1:].lower() if entry.suffix else "")
+                # One stat per entry; type comes from st_mode instead of is_dir()/is_file()
+                st = entry.stat()
+                is_dir = stat.S_ISDIR(st.st_mode)
+                is_file = stat.S_ISREG(st.st_mode)
+                size = st.st_size if is_file else 0
+                mtime = st.st_mtime
+                ext = _split_ext(name)[1].lower()
                 uploader = ""
                 uploader_name = ""
-                if entry.is_file():
+                if is_file:
                     fmeta = (meta.get("files", {}).get(name, {}) or {})
                     uploader = fmeta.get("uploader_username") or fmeta.get("uploader", "")
                     uploader_name = fmeta.get("uploader_name") or ""
-                items.append(
-                    {
-                        "name": name,
-                        "type": ext,
-                        "size": size,
-                        "modified_at": _iso8601_tw(mtime),
-                        "modified_at_display": _display_time_zh(mtime),
-                        "is_dir": is_dir,
-                        "rel_path": (Path(rel_dir or "") / name).as_posix(),
-                        "uploader": uploader,
-                        "uploader_name": uploader_name,
-                    }
-                )
             except Exception:
                 continue
-    total = len(items)
-    return items, total
+            yield {
+                "name": name,
+                "type": ext,
+                "size": size,
+                "_mtime": mtime,
+                "is_dir": is_dir,
+                "rel_path": prefix + name,
+                "uploader": uploader,
+                "uploader_name": uploader_name,
+            }
 
 
-def _apply_sort(items, field: str | None, order: str | None):
-    """Sort with folders first, then by the selected field.
+def _apply_sort(items, field: str | None, order: str | None, limit: int):
+    """Return (first ``limit`` items in display order, total item count).
 
-    Default: modified_at desc (newest first).
-    Always keep directories before files regardless of order.
+    Folders first, then by the selected field. Default: modified_at desc (newest first).
+    Always keep directories before files regardless of order. Only ``limit`` items
+    are held at a time (bounded heap), so huge keyword hits stay cheap on memory.
     """
-    from datetime import datetime
-
-    def _ts(s: str) -> float:
-        try:
-            return datetime.fromisoformat(s).timestamp()
-        except Exception:
-            return 0.0
-
     field = (field or "modified_at").lower()
     reverse = (order or "desc").lower() == "desc"
 
-    def val_key(x):
-        if field == "name":
+    # Pick the key function once instead of branching on the field per item
+    if field == "name":
+        def val_key(x):
             return (x.get("name") or "").lower()
-        if field == "type":
+    elif field == "type":
+        def val_key(x):
             return x.get("type") or ""
-        if field == "size":
+    elif field == "size":
+        def val_key(x):
             return x.get("size") or 0
-        # modified_at or unknown -> use timestamp
-        return _ts(x.get("modified_at") or "")
+    else:
+        # modified_at or unknown -> use raw mtime
+        def val_key(x):
+            return x.get("_mtime", 0.0)
 
-    dirs = [i for i in items if i.get("is_dir")]
-    files = [i for i in items if not i.get("is_dir")]
+    total = 0
 
-    dirs.sort(key=val_key, reverse=reverse)
-    files.sort(key=val_key, reverse=reverse)
+    def counted():
+        nonlocal total
+        for it in items:
+            total += 1
+            yield it
 
-    items[:] = dirs + files
+    # Same result as sorting dirs and files separately (stable) and concatenating
+    if reverse:
+        top = heapq.nlargest(limit, counted(), key=lambda x: (bool(x.get("is_dir")), val_key(x)))
+    else:
+        top = heapq.nsmallest(limit, counted(), key=lambda x: (not x.get("is_dir"), val_key(x)))
+    return top, total
 
 
 @share_bp.route("/api/share/files")
@@ -431,12 +1183,15 @@ def api_list_files():
             return jsonify({"error": "invalid pagination"}), 400
 
         root = _get_storage_root()
-        items, total = _list_dir(root, rel_dir, keyword)
-        _apply_sort(items, sort_field, sort_order)
-
         start = (page - 1) * size
         end = start + size
+        items, total = _apply_sort(_iter_items(root, rel_dir, keyword), sort_field, sort_order, end)
         page_items = items[start:end]
+        # Format timestamps only for the rows actually returned
+        for it in page_items:
+            mtime = it.pop("_mtime", 0.0)
+            it["modified_at"] = _iso8601_tw(mtime)
+            it["modified_at_display"] = _display_time_zh(mtime)
 
         return jsonify(
             {
@@ -462,6 +1217,10 @@ def api_upload():
         target_dir = _safe_join(root, rel_dir)
         target_dir.mkdir(parents=True, exist_ok=True)
 
+        # Reject oversized requests before Werkzeug parses (and spools) the body
+        if request.content_length and request.content_length > _max_request_size_bytes():
+            return jsonify({"error": "request too large"}), 413
+
         files = request.files.getlist("files[]") or request.files.getlist("files")
         if not files:
             return jsonify({"error": "no files"}), 400
@@ -474,35 +1233,37 @@ def api_upload():
 
         for f in files:
             filename = f.filename or ""
-            ext = Path(filename).suffix[1:].lower()
+            # Strip any client-side directory part (either separator) without os.path
+            safe_name = filename.rsplit("/", 1)[-1].rsplit("\\", 1)[-1]
+            ext = _split_ext(safe_name)[1].lower()
             if not filename:
                 skipped.append({"name": filename, "reason": "empty name"})
                 continue
             if ext not in allowed:
                 skipped.append({"name": filename, "reason": "extension not allowed"})
                 continue
-            # Enforce size by reading stream length if provided
-            stream = f.stream
-            pos = stream.tell()
-            stream.seek(0, os.SEEK_END)
-            size = stream.tell()
-            stream.seek(pos)
-            if size and size > max_bytes:
+            # Part header size when the client sends one; otherwise enforced while copying
+            if f.content_length and f.content_length > max_bytes:
                 skipped.append({"name": filename, "reason": "file too large"})
                 continue
 
-            safe_name = os.path.basename(filename)
             dest = target_dir / safe_name
-            f.save(str(dest))
+            size = _save_upload(f.stream, dest, max_bytes)
+            if size is None:
+                skipped.append({"name": filename, "reason": "file too large"})
+                continue
             _update_meta_on_upload(
                 target_dir,
                 safe_name,
                 session.get("username") or "",
                 session.get("name") or "",
             )
-            logging.info("share.upload user=%s path=%s file=%s size=%s", session.get("username"), rel_dir, safe_name, os.path.getsize(dest))
+            _index_upsert(dest, session.get("username") or "", session.get("name") or "")
+            logging.info("share.upload user=%s path=%s file=%s size=%s", session.get("username"), rel_dir, safe_name, size)
             uploaded.append(safe_name)
 
+        # One meta write for the whole batch
+        _flush_meta(target_dir)
         return jsonify({"ok": True, "uploaded": uploaded, "skipped": skipped})
     except ValueError:
         return jsonify({"error": "invalid path"}), 400
@@ -510,6 +1271,41 @@ def api_upload():
         return jsonify({"error": str(e)}), 500
 
 
+@lru_cache(maxsize=1)
+def _sendfile_mode() -> str:
+    # "" = stream through Flask, "x-sendfile" (Apache/IIS module), "x-accel" (nginx)
+    return os.getenv("SHARE_SENDFILE_MODE", "").strip().lower()
+
+
+def _send_stored_file(path: Path, mimetype: str | None = None, as_attachment: bool = False):
+    """Send a file under the storage root, offloading the body to the front server if configured.
+
+    With x-sendfile / x-accel the worker returns headers only and the reverse
+    proxy streams the bytes with sendfile(2). For x-accel, nginx needs an
+    ``internal`` location at SHARE_ACCEL_PREFIX aliased to the storage root.
+    """
+    mode = _sendfile_mode()
+    if mode not in ("x-sendfile", "x-accel"):
+        return send_file(str(path), mimetype=mimetype, as_attachment=as_attachment, download_name=path.name)
+    rv = _wz_send_file(
+        str(path),
+        request.environ,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=path.name,
+        use_x_sendfile=True,
+        response_class=current_app.response_class,
+        _root_path=current_app.root_path,
+    )
+    if mode == "x-accel":
+        rv.headers.pop("X-Sendfile", None)
+        # nginx takes the length from the internal location, not the empty upstream body
+        rv.headers.pop("Content-Length", None)
+        prefix = os.getenv("SHARE_ACCEL_PREFIX", "/_share_internal/")
+        rv.headers["X-Accel-Redirect"] = prefix + quote(_rel_of(path))
+    return rv
+
+
 @share_bp.route("/api/share/download")
 @login_required
 def api_download():
@@ -523,11 +1319,7 @@ def api_download():
         if not file_path.exists() or not file_path.is_file():
             return jsonify({"error": "not found"}), 404
         logging.info("share.download user=%s path=%s file=%s", session.get("username"), rel_dir, name)
-        return send_file(
-            str(file_path),
-            as_attachment=True,
-            download_name=file_path.name,
-        )
+        return _send_stored_file(file_path, as_attachment=True)
     except ValueError:
         return jsonify({"error": "invalid path"}), 400
     except Exception as e:
@@ -558,14 +1350,26 @@ def api_preview():
             token = _make_signed_token(str(file_path))
             return jsonify({"ok": True, "viewer_url": url_for("share.view_inline", token=token), "kind": "image"})
         elif ext in {"doc", "docx", "xls", "xlsx", "ppt", "pptx"}:
-            pdf = _convert_office_to_pdf(file_path)
-            if pdf and pdf.exists():
+            # Only reuse a PDF whose source hash is already known; hashing large files happens in the job
+            pdf = _known_preview_pdf_path(file_path)
+            if pdf is not None and pdf.exists():
                 logging.info("share.preview office->pdf user=%s path=%s file=%s", session.get("username"), rel_dir, name)
                 token = _make_signed_token(str(pdf))
                 return jsonify({"ok": True, "viewer_url": url_for("share.view_pdf", token=token), "kind": "pdf"})
-            # More descriptive hint for admins/operators
-            hint = "preview conversion failed (LibreOffice not found or conversion error). Check LIBREOFFICE_PATH/SHARE_CONVERT_TIMEOUT and server logs."
-            return jsonify({"ok": False, "error": hint}), 501
+            # Not cached yet: convert in the background and let the client poll
+            job_id = _submit_preview(file_path)
+            logging.info("share.preview office->pdf queued user=%s path=%s file=%s job=%s", session.get("username"), rel_dir, name, job_id)
+            return (
+                jsonify(
+                    {
+                        "ok": True,
+                        "status": "pending",
+                        "job_id": job_id,
+                        "poll_url": url_for("share.api_preview_status", job=job_id),
+                    }
+                ),
+                202,
+            )
         else:
             return jsonify({"ok": False, "error": "preview not supported"}), 415
     except ValueError:
@@ -574,32 +1378,64 @@ def api_preview():
         return jsonify({"error": str(e)}), 500
 
 
+@share_bp.route("/api/share/preview_status")
+@login_required
+def api_preview_status():
+    job_id = request.args.get("job", "")
+    job = _get_preview_job(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "unknown job"}), 404
+    status, pdf_path, submitted_at = job
+    # A worker that died mid-conversion never finishes its job; give up after the conversion timeout
+    timeout_s = int(os.getenv("SHARE_CONVERT_TIMEOUT", "180"))
+    if status == "pending" and time.time() - submitted_at < timeout_s + 60:
+        return jsonify({"ok": True, "status": "pending", "job_id": job_id, "poll_url": url_for("share.api_preview_status", job=job_id)})
+    if status == "done" and pdf_path and os.path.exists(pdf_path):
+        token = _make_signed_token(pdf_path)
+        return jsonify({"ok": True, "status": "done", "viewer_url": url_for("share.view_pdf", token=token), "kind": "pdf"})
+    # More descriptive hint for admins/operators
+    hint = "preview conversion failed (LibreOffice not found or conversion error). Check LIBREOFFICE_PATH/SHARE_CONVERT_TIMEOUT and server logs."
+    return jsonify({"ok": False, "status": "failed", "error": hint}), 501
+
+
+# (secret_key, keyed HMAC) — copying a keyed HMAC skips the per-call key setup
+_HMAC_PROTO: tuple[str, hmac.HMAC] | None = None
+
+
+def _hmac_hex(payload: bytes) -> str:
+    global _HMAC_PROTO
+    secret = current_app.secret_key or ""
+    if _HMAC_PROTO is None or _HMAC_PROTO[0] != secret:
+        _HMAC_PROTO = (secret, hmac.new(secret.encode("utf-8"), None, hashlib.sha256))
+    m = _HMAC_PROTO[1].copy()
+    m.update(payload)
+    return m.hexdigest()
+
+
 def _make_signed_token(abs_path: str) -> str:
     # very simple HMAC-like token using secret_key; includes expiry
-    import hmac
-    import hashlib
-
-    secret = (current_app.secret_key or "").encode("utf-8")
     expires = int(datetime.now(tz=_tz_tw()).timestamp()) + int(
         os.getenv("SHARE_PREVIEW_TTL", "600")
     )
     payload = f"{abs_path}|{expires}".encode("utf-8")
-    sig = hmac.new(secret, payload, hashlib.sha256).hexdigest()
+    sig = _hmac_hex(payload)
     return f"{abs_path}|{expires}|{sig}"
 
 
-def _verify_signed_token(token: str) -> Path | None:
-    import hmac
-    import hashlib
+_SIG_HEX_LEN = hashlib.sha256().digest_size * 2
+
 
+def _verify_signed_token(token: str) -> Path | None:
     try:
         abs_path, expires_str, sig = token.rsplit("|", 2)
         expires = int(expires_str)
     except Exception:
         return None
-    secret = (current_app.secret_key or "").encode("utf-8")
+    # Malformed signatures can be rejected without computing the HMAC
+    if len(sig) != _SIG_HEX_LEN:
+        return None
     payload = f"{abs_path}|{expires}".encode("utf-8")
-    expected = hmac.new(secret, payload, hashlib.sha256).hexdigest()
+    expected = _hmac_hex(payload)
     if not hmac.compare_digest(expected, sig):
         return None
     now_ts = int(datetime.now(tz=_tz_tw()).timestamp())
@@ -623,7 +1459,7 @@ def view_pdf():
     p = _verify_signed_token(token)
     if not p or not p.exists() or not p.is_file():
         return jsonify({"error": "invalid token"}), 400
-    return send_file(str(p), mimetype="application/pdf", as_attachment=False, download_name=p.name)
+    return _send_stored_file(p, mimetype="application/pdf")
 
 
 @share_bp.route("/api/share/view_inline")
@@ -634,7 +1470,7 @@ def view_inline():
     if not p or not p.exists() or not p.is_file():
         return jsonify({"error": "invalid token"}), 400
     mime, _ = mimetypes.guess_type(p.name)
-    return send_file(str(p), mimetype=mime or "application/octet-stream", as_attachment=False, download_name=p.name)
+    return _send_stored_file(p, mimetype=mime or "application/octet-stream")
 
 
 @share_bp.route("/api/share/mkdir", methods=["POST"])
@@ -649,6 +1485,11 @@ def api_mkdir():
         root = _get_storage_root()
         target = _safe_join(root, rel_path, name)
         target.mkdir(parents=True, exist_ok=True)
+        # Index the new folder and any intermediate folders created with it
+        for p in [target, *target.parents]:
+            if p == root:
+                break
+            _index_upsert(p)
         return jsonify({"ok": True})
     except ValueError:
         return jsonify({"error": "invalid path"}), 400
@@ -670,11 +1511,13 @@ def api_delete_file():
             return jsonify({"error": "not found"}), 404
         if target.is_file():
             # Permission: admin or uploader of the file
-            uploader = _get_uploader_for(target.parent, target.name) or ""
+            meta = _load_meta(target.parent)
+            uploader = _get_uploader_for(target.parent, target.name, meta) or ""
             if not (_is_admin() or (uploader and uploader == (session.get("username") or ""))):
                 return jsonify({"error": "forbidden"}), 403
             target.unlink()
-            _update_meta_on_delete(target.parent, target.name)
+            _update_meta_on_delete(target.parent, target.name, meta)
+            _index_remove(target)
             logging.info("share.delete file user=%s path=%s file=%s", session.get("username"), rel_dir, name)
             return jsonify({"ok": True, "deleted": name})
         if target.is_dir():
@@ -684,6 +1527,7 @@ def api_delete_file():
                 if not _is_admin():
                     return jsonify({"error": "forbidden"}), 403
                 target.rmdir()
+                _index_remove(target)
                 logging.info("share.delete dir user=%s path=%s dir=%s", session.get("username"), rel_dir, name)
                 return jsonify({"ok": True, "deleted": name})
             except OSError:
@@ -724,39 +1568,32 @@ def api_rename():
             return jsonify({"error": "target exists"}), 409
 
         # Permission + validation
+        meta = _load_meta(src.parent)
         if src.is_dir():
             # Directories: admin only
             if not _is_admin():
                 return jsonify({"error": "forbidden"}), 403
         else:
             # Files: admin or uploader of the file
-            uploader = _get_uploader_for(src.parent, src.name) or ""
+            uploader = _get_uploader_for(src.parent, src.name, meta) or ""
             if not (_is_admin() or (uploader and uploader == (session.get("username") or ""))):
                 return jsonify({"error": "forbidden"}), 403
             # Enforce keeping the same extension to avoid format change
-            old_ext = Path(old_name).suffix.lower()
-            new_ext_full = Path(new_name).suffix.lower()
-            if old_ext != new_ext_full:
+            old_ext = _split_ext(old_name)[1].lower()
+            new_ext = _split_ext(new_name)[1].lower()
+            if old_ext != new_ext:
                 return jsonify({"error": "cannot change extension"}), 400
             # Ensure extension is still allowed (defensive)
             allowed = _allowed_ext_set()
-            if old_ext and old_ext[1:] not in allowed:
+            if old_ext and old_ext not in allowed:
                 return jsonify({"error": "extension not allowed"}), 400
 
+        if src.is_dir():
+            # Pending meta writes are keyed by folder path; land them before it moves
+            _flush_meta()
         src.rename(dst)
-        _update_meta_on_rename(dst.parent, old_name, new_name)
-
-        # Try to move cached preview if any (best-effort)
-        try:
-            prev_dir = _get_preview_cache_root() / Path(rel_path)
-            if src.is_file():
-                # move .pdf cache for office files or pdf itself
-                src_pdf = prev_dir / (Path(old_name).with_suffix(".pdf").name)
-                dst_pdf = prev_dir / (Path(new_name).with_suffix(".pdf").name)
-                if src_pdf.exists() and not dst_pdf.exists():
-                    src_pdf.rename(dst_pdf)
-        except Exception:
-            pass
+        _update_meta_on_rename(dst.parent, old_name, new_name, meta)
+        _index_rename(src, dst)
 
         logging.info("share.rename user=%s path=%s old=%s new=%s", session.get("username"), rel_path, old_name, new_name)
         return jsonify({"ok": True, "old": old_name, "new": new_name})
@@ -1,9 +1,21 @@
-from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, send_file, g, current_app
 import sqlite3
 import os
 import pandas as pd
 from datetime import datetime, date
-import io
+import hashlib
+import json
+import re
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import xlsxwriter
+except ImportError:  # 沒有 xlsxwriter 時改用 openpyxl 的 write-only 模式
+    xlsxwriter = None
 
 # 建立 Blueprint
 inventory_bp = Blueprint(
@@ -21,13 +33,423 @@ def require_login_for_inventory():
     if 'logged_in' not in session:
         return redirect(url_for('login'))
 
-# 資料庫連線函式
-def get_inventory_db_connection(db_name):
-    db_path = os.path.join(os.path.dirname(__file__), 'database', db_name)
-    conn = sqlite3.connect(db_path)
+# 盤點系統資料庫（產品、倉別、盤點記錄合併於同一檔案）
+DB_DIR = os.path.join(os.path.dirname(__file__), 'database')
+DB_PATH = os.path.join(DB_DIR, 'inventory.db')
+
+# 舊版分開存放的資料庫檔案，初始化時會搬移到 inventory.db
+LEGACY_DATABASES = {
+    'products': 'products.db',
+    'warehouses': 'warehouses.db',
+    'inventory_records': 'inventory_records.db',
+}
+
+# 每個連線都要設定的 PRAGMA（journal_mode=WAL 會寫入資料庫檔案，於初始化時設定）
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+)
+
+def connect_db():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+# 資料庫連線函式：同一請求共用一條連線，請求結束時由 close_conn 關閉
+def get_conn():
+    conn = g.get('inventory_db')
+    if conn is None:
+        conn = connect_db()
+        g.inventory_db = conn
     return conn
 
+@inventory_bp.teardown_app_request
+def close_conn(exception=None):
+    conn = g.pop('inventory_db', None)
+    if conn is not None:
+        conn.close()
+
+def _table_columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info({table})').fetchall()]
+
+def attach_legacy_databases(conn):
+    """ATTACH 尚存在的舊版資料庫檔案（需在交易外執行），返回 {資料表: schema 名稱}"""
+    attached = {}
+    for table, filename in LEGACY_DATABASES.items():
+        legacy_path = os.path.join(DB_DIR, filename)
+        if os.path.exists(legacy_path):
+            schema = f'legacy_{table}'
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (legacy_path,))
+            attached[table] = schema
+    return attached
+
+def migrate_legacy_databases(conn, attached):
+    """將舊版 products.db / warehouses.db / inventory_records.db 的資料搬入 inventory.db（僅在目標表為空時）"""
+    for table, schema in attached.items():
+        legacy_cols = _table_columns(conn, schema, table)
+        if not legacy_cols:
+            continue
+        main_cols = _table_columns(conn, 'main', table)
+        if not main_cols:
+            # 參考資料表沿用舊表結構（與 Excel 欄位一致）
+            conn.execute(f'CREATE TABLE main.{table} AS SELECT * FROM {schema}.{table}')
+            continue
+        if conn.execute(f'SELECT 1 FROM main.{table} LIMIT 1').fetchone():
+            continue
+        cols = ', '.join(c for c in legacy_cols if c in main_cols)
+        conn.execute(f'INSERT INTO main.{table} ({cols}) SELECT {cols} FROM {schema}.{table}')
+
+def ensure_schema(conn):
+    """建立盤點系統資料表並搬移舊版資料庫；每個行程啟動時執行一次，可重複執行"""
+    # 啟用 WAL：讀取不會被寫入阻塞（需在交易外設定）
+    conn.execute('PRAGMA journal_mode=WAL')
+    attached = attach_legacy_databases(conn)
+    try:
+        # 多個工作行程可能同時啟動，先取得寫入鎖，避免重複搬移舊資料
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS inventory_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                qr_code TEXT,
+                product_name TEXT,
+                warehouse_code TEXT,
+                warehouse_name TEXT,
+                quantity INTEGER,
+                inventory_date DATE,
+                inventory_time DATETIME,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # 日期範圍查詢（統計、匯出）與使用者當日查詢（儲存、今日記錄、倉別）皆可走索引範圍掃描
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ir_date_user ON inventory_records(inventory_date, user_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ir_user_date_wh ON inventory_records(user_id, inventory_date, warehouse_code)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_qr_code_records ON inventory_records(qr_code)')
+        # 已被上面兩個複合索引取代
+        conn.execute('DROP INDEX IF EXISTS idx_user_date')
+        conn.execute('DROP INDEX IF EXISTS idx_inventory_date')
+
+        # 搬移舊版分開的資料庫檔案
+        migrate_legacy_databases(conn, attached)
+
+        # 同一使用者當日同產品同倉別只保留一筆（舊資料若有重複保留最新一筆），供儲存時 UPSERT
+        # 被移除的舊記錄先備份到 inventory_records_duplicates，可供人工核對
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uq_ir'").fetchone():
+            duplicate_filter = '''
+                WHERE user_id IS NOT NULL AND qr_code IS NOT NULL
+                  AND warehouse_code IS NOT NULL AND inventory_date IS NOT NULL
+                  AND id NOT IN (
+                      SELECT MAX(id) FROM inventory_records
+                      GROUP BY user_id, qr_code, warehouse_code, inventory_date
+                  )
+            '''
+            conn.execute('CREATE TABLE IF NOT EXISTS inventory_records_duplicates AS SELECT * FROM inventory_records WHERE 0')
+            archived = conn.execute(f'INSERT INTO inventory_records_duplicates SELECT * FROM inventory_records {duplicate_filter}').rowcount
+            conn.execute(f'DELETE FROM inventory_records {duplicate_filter}')
+            if archived:
+                print(f"盤點記錄重複資料：已保留最新一筆，{archived} 筆舊記錄移至 inventory_records_duplicates")
+            conn.execute('''
+                CREATE UNIQUE INDEX uq_ir
+                ON inventory_records(user_id, qr_code, warehouse_code, inventory_date)
+            ''')
+
+        # 沒有舊資料也尚未匯入 Excel 時先建立空表，由 init_database 載入資料
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                qr_code TEXT UNIQUE,
+                product_name TEXT,
+                product_code TEXT,
+                specification TEXT,
+                unit TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS warehouses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                warehouse_code TEXT UNIQUE,
+                warehouse_name TEXT,
+                description TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # 搬移的舊表（CREATE TABLE AS）不帶索引與 UNIQUE 限制，條碼、倉別代碼查詢需補建索引
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_qr_code ON products(qr_code)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_product_code ON products(product_code)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_warehouse_code ON warehouses(warehouse_code)')
+
+        # 產品全文索引（搬移或新建的產品表尚未建立時）
+        if not _table_columns(conn, 'main', 'products_fts'):
+            rebuild_products_fts(conn)
+
+        # 背景匯出工作狀態
+        ensure_export_jobs_table(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        for schema in attached.values():
+            conn.execute(f'DETACH DATABASE {schema}')
+
+@inventory_bp.record_once
+def init_schema_on_register(state):
+    """Blueprint 註冊到 app 時建立資料表並搬移舊版資料庫一次，不必等管理員執行初始化"""
+    os.makedirs(DB_DIR, exist_ok=True)
+    conn = connect_db()
+    try:
+        ensure_schema(conn)
+    finally:
+        conn.close()
+
+def rebuild_products_fts(conn):
+    """重建產品全文索引：trigram 斷詞可做中文子字串搜尋，不必每次 LIKE '%關鍵字%' 全表掃描"""
+    columns = _table_columns(conn, 'main', 'products')
+    if 'product_name' not in columns or 'product_code' not in columns:
+        return
+    conn.execute('DROP TABLE IF EXISTS products_fts')
+    conn.execute('''
+        CREATE VIRTUAL TABLE products_fts USING fts5(
+            product_name, product_code, content='products', tokenize='trigram'
+        )
+    ''')
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES('rebuild')")
+    # products 表以 to_sql 重建時觸發器會一併刪除，因此每次初始化重新建立
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, product_name, product_code)
+            VALUES (new.rowid, new.product_name, new.product_code);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, product_name, product_code)
+            VALUES ('delete', old.rowid, old.product_name, old.product_code);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, product_name, product_code)
+            VALUES ('delete', old.rowid, old.product_name, old.product_code);
+            INSERT INTO products_fts(rowid, product_name, product_code)
+            VALUES (new.rowid, new.product_name, new.product_code);
+        END
+    ''')
+    conn.commit()
+
+# 舊版 SQLite 單一語句最多 999 個參數，method='multi' 時每批列數 × 欄數需低於此值
+SQLITE_MAX_PARAMS = 900
+
+def load_dataframe(conn, df, table):
+    """以多列 INSERT 分批（單一交易）將 DataFrame 寫入資料表，取代原有資料"""
+    chunksize = max(1, SQLITE_MAX_PARAMS // max(1, len(df.columns)))
+    with conn:
+        df.to_sql(table, conn, if_exists='replace', index=False, method='multi', chunksize=chunksize)
+
+# 匯出Excel設定
+EXPORT_HEADERS = ['使用者帳號', 'QR Code', '產品名稱', '倉別代碼', '倉別名稱',
+                  '盤點數量', '盤點日期', '盤點時間', '最後更新時間']
+EXPORT_CHUNK_SIZE = 10_000
+
+def _iter_rows(chunks):
+    for chunk in chunks:
+        # NaN 寫成空白儲存格
+        yield from chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+def write_excel(chunks, filepath, sheet_name, headers):
+    """將多個 DataFrame 區塊依序逐列寫成 xlsx，記憶體用量與總筆數無關；優先使用 xlsxwriter"""
+    rows = _iter_rows(chunks)
+    if xlsxwriter is not None:
+        # constant_memory 只保留目前這一列，須依列順序寫入（不能交給 pandas 逐欄寫）
+        wb = xlsxwriter.Workbook(filepath, {'constant_memory': True})
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, headers)
+        for row_idx, row in enumerate(rows, start=1):
+            ws.write_row(row_idx, 0, row)
+        wb.close()
+        return
+
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=sheet_name)
+    ws.append(headers)
+    for row in rows:
+        ws.append(row)
+    wb.save(filepath)
+
+# 超過此筆數改用 write_xlsx_xml 直接輸出工作表 XML
+LARGE_EXPORT_ROWS = 100_000
+
+_XML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+_XML_ESCAPE_RE = re.compile(r'[&<>]|[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xml_escape(text):
+    # XML 不允許的控制字元直接移除
+    return _XML_ESCAPE_RE.sub(lambda m: _XML_ESCAPES.get(m.group(), ''), text)
+
+def _xml_row(values):
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('<c/>')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{_xml_escape(str(value))}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+_XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+def write_xlsx_xml(chunks, filepath, sheet_name, headers):
+    """大量資料匯出：不經 Excel 套件，直接把每列寫成工作表 XML 串流進 zip"""
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', _XLSX_CONTENT_TYPES)
+        zf.writestr('_rels/.rels', _XLSX_ROOT_RELS)
+        zf.writestr('xl/workbook.xml', _XLSX_WORKBOOK.format(sheet_name=_xml_escape(sheet_name).replace('"', '&quot;')))
+        zf.writestr('xl/_rels/workbook.xml.rels', _XLSX_WORKBOOK_RELS)
+        zf.writestr('xl/styles.xml', _XLSX_STYLES)
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xml_row(headers).encode('utf-8'))
+            # 每個區塊組成一段字串後寫入一次
+            for chunk in chunks:
+                rows = chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+                sheet.write(''.join(_xml_row(row) for row in rows).encode('utf-8'))
+            sheet.write(b'</sheetData></worksheet>')
+
+# 背景匯出：請求只建立工作並回傳 job_id，Excel 在背景執行緒產生；
+# 狀態記錄在 export_jobs 資料表，多個工作行程都能查詢與下載
+EXPORTS_DIR = os.path.join(os.path.dirname(__file__), 'exports')
+_EXPORT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inventory-export')
+# 超過此秒數仍未完成的匯出工作視為失敗（執行緒或工作行程中途結束時不會再更新狀態）
+EXPORT_JOB_TIMEOUT = int(os.getenv('INVENTORY_EXPORT_TIMEOUT', '1800'))
+
+def ensure_export_jobs_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            filename TEXT,
+            download_name TEXT,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+    ''')
+    conn.commit()
+
+def run_export_job(job_id, start_date, end_date):
+    """背景執行緒：查詢盤點記錄並寫成 Excel，完成後更新 export_jobs 狀態"""
+    conn = connect_db()
+    try:
+        conn.execute("UPDATE export_jobs SET status = 'running' WHERE job_id = ?", (job_id,))
+        conn.commit()
+
+        # 查詢指定日期範圍的盤點記錄；如果沒有指定日期，匯出所有記錄
+        if start_date and end_date:
+            where, params = 'WHERE inventory_date BETWEEN ? AND ?', (start_date, end_date)
+        else:
+            where, params = '', ()
+
+        total = conn.execute(f'SELECT COUNT(*) FROM inventory_records {where}', params).fetchone()[0]
+        if not total:
+            conn.execute('''
+                UPDATE export_jobs SET status = 'empty', error = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE job_id = ?
+            ''', ('查無資料', job_id))
+            conn.commit()
+            return
+
+        # 分批讀成DataFrame，大範圍匯出也不會整批載入記憶體
+        chunks = pd.read_sql_query(f'''
+            SELECT user_id, qr_code, product_name, warehouse_code, warehouse_name, 
+                   quantity, inventory_date, inventory_time, updated_at
+            FROM inventory_records 
+            {where}
+            ORDER BY inventory_date DESC, inventory_time DESC
+        ''', conn, params=params, chunksize=EXPORT_CHUNK_SIZE)
+
+        # 產生檔案名稱（伺服器上的檔名加上工作代碼避免同秒重複）
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        download_name = f'盤點結果_{timestamp}.xlsx'
+        filename = f'盤點結果_{timestamp}_{job_id[:8]}.xlsx'
+
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+        writer = write_xlsx_xml if total > LARGE_EXPORT_ROWS else write_excel
+        writer(chunks, os.path.join(EXPORTS_DIR, filename), '盤點結果', EXPORT_HEADERS)
+
+        conn.execute('''
+            UPDATE export_jobs SET status = 'done', filename = ?, download_name = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        ''', (filename, download_name, job_id))
+        conn.commit()
+
+    except Exception as e:
+        print(f"匯出錯誤：{str(e)}")
+        conn.rollback()
+        conn.execute('''
+            UPDATE export_jobs SET status = 'error', error = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        ''', (f'匯出失敗：{str(e)}', job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+# 管理後台統計快取（資料異動時清除）
+STATS_CACHE_TTL = 30
+_stats_cache = {}
+
+def invalidate_stats_cache():
+    _stats_cache.pop('stats', None)
+
 # 盤點系統首頁
 @inventory_bp.route('/')
 def index():
@@ -44,7 +466,7 @@ def admin():
 # 匯出盤點結果（僅限C4D002帳號）
 @inventory_bp.route('/export_inventory', methods=['POST'])
 def export_inventory():
-    """匯出盤點結果"""
+    """建立匯出工作，回傳 job_id 供前端查詢進度"""
     if session.get('username') != 'C4D002':
         return jsonify({'success': False, 'error': '無權限執行此操作'})
     
@@ -53,69 +475,82 @@ def export_inventory():
         start_date = data.get('start_date')
         end_date = data.get('end_date')
         
-        conn = get_inventory_db_connection('inventory_records.db')
-        cursor = conn.cursor()
+        conn = get_conn()
         
-        # 查詢指定日期範圍的盤點記錄
-        if start_date and end_date:
-            cursor.execute('''
-                SELECT user_id, qr_code, product_name, warehouse_code, warehouse_name, 
-                       quantity, inventory_date, inventory_time, updated_at
-                FROM inventory_records 
-                WHERE inventory_date BETWEEN ? AND ?
-                ORDER BY inventory_date DESC, inventory_time DESC
-            ''', (start_date, end_date))
-        else:
-            # 如果沒有指定日期，匯出所有記錄
-            cursor.execute('''
-                SELECT user_id, qr_code, product_name, warehouse_code, warehouse_name, 
-                       quantity, inventory_date, inventory_time, updated_at
-                FROM inventory_records 
-                ORDER BY inventory_date DESC, inventory_time DESC
-            ''')
+        job_id = uuid.uuid4().hex
+        conn.execute("INSERT INTO export_jobs (job_id, status) VALUES (?, 'pending')", (job_id,))
+        conn.commit()
         
-        records = cursor.fetchall()
-        conn.close()
+        _EXPORT_EXECUTOR.submit(run_export_job, job_id, start_date, end_date)
         
-        # 轉換為DataFrame並匯出Excel
-        if records:
-            df = pd.DataFrame([dict(record) for record in records])
-
-            # 重新命名欄位
-            df.columns = ['使用者帳號', 'QR Code', '產品名稱', '倉別代碼', '倉別名稱',
-                         '盤點數量', '盤點日期', '盤點時間', '最後更新時間']
-
-            # 產生檔案名稱
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f'盤點結果_{timestamp}.xlsx'
-
-            # 使用記憶體緩衝區來建立Excel檔案
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='盤點結果')
-
-            output.seek(0)
-
-            # 同時儲存到伺服器（備份）
-            exports_dir = os.path.join(os.path.dirname(__file__), 'exports')
-            os.makedirs(exports_dir, exist_ok=True)
-            filepath = os.path.join(exports_dir, filename)
-            df.to_excel(filepath, index=False, engine='openpyxl')
-
-            # 直接返回檔案供下載
-            return send_file(
-                output,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name=filename
-            )
-        else:
-            return jsonify({'success': False, 'error': '查無資料'})
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': url_for('inventory.export_status', job_id=job_id)
+        })
             
     except Exception as e:
         print(f"匯出錯誤：{str(e)}")
         return jsonify({'success': False, 'error': f'匯出失敗：{str(e)}'})
 
+# 查詢匯出工作狀態（僅限C4D002帳號）
+@inventory_bp.route('/export_status/<job_id>')
+def export_status(job_id):
+    """查詢匯出工作狀態：pending / running / done / empty / error"""
+    if session.get('username') != 'C4D002':
+        return jsonify({'success': False, 'error': '無權限執行此操作'})
+    
+    try:
+        conn = get_conn()
+        conn.execute('''
+            UPDATE export_jobs SET status = 'error', error = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status IN ('pending', 'running')
+              AND (julianday('now') - julianday(created_at)) * 86400 > ?
+        ''', ('匯出逾時，請重新匯出', job_id, EXPORT_JOB_TIMEOUT))
+        conn.commit()
+        job = conn.execute('SELECT status, error FROM export_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        
+        if not job:
+            return jsonify({'success': False, 'error': '找不到匯出工作'})
+        
+        result = {'success': True, 'status': job['status']}
+        if job['status'] == 'done':
+            result['download_url'] = url_for('inventory.export_download', job_id=job_id)
+        elif job['error']:
+            result['error'] = job['error']
+        return jsonify(result)
+        
+    except Exception as e:
+        print(f"查詢匯出狀態錯誤：{str(e)}")
+        return jsonify({'success': False, 'error': '查詢匯出狀態失敗'})
+
+# 下載已完成的匯出檔案（僅限C4D002帳號）
+@inventory_bp.route('/export_download/<job_id>')
+def export_download(job_id):
+    """下載匯出檔案"""
+    if session.get('username') != 'C4D002':
+        return jsonify({'success': False, 'error': '無權限執行此操作'})
+    
+    try:
+        conn = get_conn()
+        job = conn.execute(
+            "SELECT filename, download_name FROM export_jobs WHERE job_id = ? AND status = 'done'", (job_id,)
+        ).fetchone()
+        
+        if not job:
+            return jsonify({'success': False, 'error': '匯出檔案尚未完成'})
+        
+        return send_file(
+            os.path.join(EXPORTS_DIR, job['filename']),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            as_attachment=True,
+            download_name=job['download_name']
+        )
+        
+    except Exception as e:
+        print(f"下載匯出檔案錯誤：{str(e)}")
+        return jsonify({'success': False, 'error': f'下載失敗：{str(e)}'})
+
 # 獲取盤點統計資料（僅限C4D002帳號）
 @inventory_bp.route('/get_inventory_stats')
 def get_inventory_stats():
@@ -123,56 +558,68 @@ def get_inventory_stats():
     if session.get('username') != 'C4D002':
         return jsonify({'error': '無權限執行此操作'})
     
+    cached = _stats_cache.get('stats')
+    if cached and cached[0] > time.monotonic():
+        return jsonify(cached[1])
+    
     try:
-        conn = get_inventory_db_connection('inventory_records.db')
+        conn = get_conn()
         cursor = conn.cursor()
         
-        # 總記錄數
-        cursor.execute('SELECT COUNT(*) as total FROM inventory_records')
-        total_records = cursor.fetchone()['total']
-        
-        # 今日記錄數
+        # 所有統計以單一查詢取得，第一欄標示統計類別
         today = date.today()
-        cursor.execute('SELECT COUNT(*) as today_total FROM inventory_records WHERE inventory_date = ?', (today,))
-        today_records = cursor.fetchone()['today_total']
-        
-        # 使用者統計
         cursor.execute('''
-            SELECT user_id, COUNT(*) as count 
-            FROM inventory_records 
-            GROUP BY user_id 
-            ORDER BY count DESC
-        ''')
-        user_stats = cursor.fetchall()
-        
-        # 倉別統計
-        cursor.execute('''
-            SELECT warehouse_code, warehouse_name, COUNT(*) as count 
-            FROM inventory_records 
-            GROUP BY warehouse_code, warehouse_name 
-            ORDER BY count DESC
-        ''')
-        warehouse_stats = cursor.fetchall()
-        
-        # 最近7天的記錄統計
-        cursor.execute('''
-            SELECT inventory_date, COUNT(*) as count 
-            FROM inventory_records 
+            SELECT 'total' AS kind, NULL AS key1, NULL AS key2, COUNT(*) AS count
+            FROM inventory_records
+            UNION ALL
+            SELECT 'today', NULL, NULL, COUNT(*)
+            FROM inventory_records
+            WHERE inventory_date = ?
+            UNION ALL
+            SELECT 'user', user_id, NULL, COUNT(*)
+            FROM inventory_records
+            GROUP BY user_id
+            UNION ALL
+            SELECT 'warehouse', warehouse_code, warehouse_name, COUNT(*)
+            FROM inventory_records
+            GROUP BY warehouse_code, warehouse_name
+            UNION ALL
+            SELECT 'day', inventory_date, NULL, COUNT(*)
+            FROM inventory_records
             WHERE inventory_date >= date('now', '-7 days')
-            GROUP BY inventory_date 
-            ORDER BY inventory_date DESC
-        ''')
-        daily_stats = cursor.fetchall()
-        
-        conn.close()
-        
-        return jsonify({
+            GROUP BY inventory_date
+        ''', (today,))
+        
+        total_records = 0
+        today_records = 0
+        user_stats = []
+        warehouse_stats = []
+        daily_stats = []
+        for kind, key1, key2, count in cursor.fetchall():
+            if kind == 'total':
+                total_records = count
+            elif kind == 'today':
+                today_records = count
+            elif kind == 'user':
+                user_stats.append({'user_id': key1, 'count': count})
+            elif kind == 'warehouse':
+                warehouse_stats.append({'warehouse_code': key1, 'warehouse_name': key2, 'count': count})
+            else:
+                daily_stats.append({'inventory_date': key1, 'count': count})
+        
+        user_stats.sort(key=lambda stat: stat['count'], reverse=True)
+        warehouse_stats.sort(key=lambda stat: stat['count'], reverse=True)
+        daily_stats.sort(key=lambda stat: stat['inventory_date'], reverse=True)
+        
+        stats = {
             'total_records': total_records,
             'today_records': today_records,
-            'user_stats': [dict(stat) for stat in user_stats],
-            'warehouse_stats': [dict(stat) for stat in warehouse_stats],
-            'daily_stats': [dict(stat) for stat in daily_stats]
-        })
+            'user_stats': user_stats,
+            'warehouse_stats': warehouse_stats,
+            'daily_stats': daily_stats
+        }
+        _stats_cache['stats'] = (time.monotonic() + STATS_CACHE_TTL, stats)
+        return jsonify(stats)
         
     except Exception as e:
         print(f"獲取統計資料錯誤：{str(e)}")
@@ -183,18 +630,13 @@ def get_inventory_stats():
 def init_database():
     """將Excel檔案轉換為SQLite資料庫"""
     try:
-        # 確保database目錄存在
-        db_dir = os.path.join(os.path.dirname(__file__), 'database')
-        if not os.path.exists(db_dir):
-            os.makedirs(db_dir)
-        
         # 轉換產品對照資料
         product_file = os.path.join('Inventory system', '產品對照資料.xlsx')
         if os.path.exists(product_file):
             df_products = pd.read_excel(product_file)
             
-            # 建立產品資料庫
-            conn = get_inventory_db_connection('products.db')
+            # 建立產品資料表
+            conn = get_conn()
             cursor = conn.cursor()
             
             # 建立產品表
@@ -211,22 +653,21 @@ def init_database():
             ''')
             
             # 插入產品資料
-            df_products.to_sql('products', conn, if_exists='replace', index=False, method='multi')
+            load_dataframe(conn, df_products, 'products')
             
             # 建立索引
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_qr_code ON products(qr_code)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_code ON products(product_code)')
             
             conn.commit()
-            conn.close()
         
         # 轉換倉別資料
         warehouse_file = os.path.join('Inventory system', '倉別.xlsx')
         if os.path.exists(warehouse_file):
             df_warehouses = pd.read_excel(warehouse_file)
             
-            # 建立倉別資料庫
-            conn = get_inventory_db_connection('warehouses.db')
+            # 建立倉別資料表
+            conn = get_conn()
             cursor = conn.cursor()
             
             # 建立倉別表
@@ -241,38 +682,24 @@ def init_database():
             ''')
             
             # 插入倉別資料
-            df_warehouses.to_sql('warehouses', conn, if_exists='replace', index=False, method='multi')
+            load_dataframe(conn, df_warehouses, 'warehouses')
+
+            # 建立索引
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_warehouse_code ON warehouses(warehouse_code)')
             
             conn.commit()
-            conn.close()
-        
-        # 建立盤點記錄資料庫
-        conn = get_inventory_db_connection('inventory_records.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS inventory_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                qr_code TEXT,
-                product_name TEXT,
-                warehouse_code TEXT,
-                warehouse_name TEXT,
-                quantity INTEGER,
-                inventory_date DATE,
-                inventory_time DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 建立索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_date ON inventory_records(user_id, inventory_date)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_qr_code_records ON inventory_records(qr_code)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_date ON inventory_records(inventory_date)')
         
+        conn = get_conn()
+
+        # 產品全文索引
+        rebuild_products_fts(conn)
+
+        # 更新統計資訊，讓查詢規劃器選用新索引
+        conn.execute('ANALYZE')
         conn.commit()
-        conn.close()
+        invalidate_stats_cache()
+        lookup_product.cache_clear()
+        load_warehouses.cache_clear()
         
         return jsonify({'success': True, 'message': '資料庫初始化成功'})
         
@@ -280,38 +707,62 @@ def init_database():
         print(f"資料庫初始化錯誤：{str(e)}")
         return jsonify({'success': False, 'error': f'資料庫初始化失敗：{str(e)}'})
 
+def reference_data_version(conn):
+    """產品、倉別表只由 init_database 以 to_sql 整表重建，schema_version 會跟著改變，各工作行程都讀得到"""
+    return conn.execute('PRAGMA schema_version').fetchone()[0]
+
+def payload_etag(payload):
+    """以內容雜湊當 ETag，各工作行程與重新啟動後都一致"""
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def json_with_etag(payload, etag):
+    """用戶端的 If-None-Match 相符時直接回 304，不必重新序列化 JSON"""
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(etag)
+    return response
+
+# 倉別資料只在初始化資料庫時變動，載入一次後由記憶體回應（version 同 lookup_product）
+@lru_cache(maxsize=1)
+def load_warehouses(version):
+    rows = get_conn().execute('SELECT warehouse_code, warehouse_name FROM warehouses ORDER BY warehouse_code').fetchall()
+    warehouses = [dict(row) for row in rows]
+    return warehouses, payload_etag(warehouses)
+
 # 獲取倉別清單
 @inventory_bp.route('/get_warehouses')
 def get_warehouses():
     """獲取所有倉別資料"""
     try:
-        conn = get_inventory_db_connection('warehouses.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT warehouse_code, warehouse_name FROM warehouses ORDER BY warehouse_code')
-        warehouses = cursor.fetchall()
-        conn.close()
-        
-        return jsonify([dict(warehouse) for warehouse in warehouses])
+        warehouses, etag = load_warehouses(reference_data_version(get_conn()))
+        return json_with_etag(warehouses, etag)
         
     except Exception as e:
         print(f"獲取倉別資料錯誤：{str(e)}")
         return jsonify({'error': '獲取倉別資料失敗'})
 
+# 產品資料只在初始化資料庫時變動，重複掃描同一條碼直接由快取回應
+# version 為 reference_data_version()，其他工作行程重新初始化後自然改用新的快取項目
+@lru_cache(maxsize=4096)
+def lookup_product(qr_code, version):
+    product = get_conn().execute('SELECT * FROM products WHERE qr_code = ?', (qr_code,)).fetchone()
+    if not product:
+        return None
+    product = dict(product)
+    return product, payload_etag(product)
+
 # 根據QR Code查詢產品
 @inventory_bp.route('/get_product/<qr_code>')
 def get_product(qr_code):
     """根據QR Code查詢產品資訊"""
     try:
-        conn = get_inventory_db_connection('products.db')
-        cursor = conn.cursor()
+        cached = lookup_product(qr_code, reference_data_version(get_conn()))
 
-        cursor.execute('SELECT * FROM products WHERE qr_code = ?', (qr_code,))
-        product = cursor.fetchone()
-        conn.close()
-
-        if product:
-            return jsonify(dict(product))
+        if cached:
+            product, etag = cached
+            return json_with_etag(product, etag)
         else:
             return jsonify({'error': '找不到對應的產品'})
 
@@ -332,20 +783,37 @@ def search_products():
         if len(keyword) < 2:
             return jsonify({'error': '搜尋關鍵字至少需要2個字元'})
 
-        conn = get_inventory_db_connection('products.db')
+        conn = get_conn()
         cursor = conn.cursor()
 
-        # 使用LIKE進行模糊搜尋，搜尋產品名稱和產品代碼
-        search_pattern = f'%{keyword}%'
-        cursor.execute('''
-            SELECT * FROM products
-            WHERE product_name LIKE ? OR product_code LIKE ?
-            ORDER BY product_name
-            LIMIT 20
-        ''', (search_pattern, search_pattern))
+        # 以全文索引搜尋產品名稱和產品代碼（trigram 需至少3個字元）
+        products = None
+        if len(keyword) >= 3:
+            phrase = '"' + keyword.replace('"', '""') + '"'
+            try:
+                cursor.execute('''
+                    SELECT p.* FROM products_fts f
+                    JOIN products p ON p.rowid = f.rowid
+                    WHERE products_fts MATCH ?
+                    ORDER BY p.product_name
+                    LIMIT 20
+                ''', (phrase,))
+                products = cursor.fetchall()
+            except sqlite3.OperationalError:
+                # 尚未建立全文索引（未重新初始化資料庫）
+                products = None
+
+        if products is None:
+            # 使用LIKE進行模糊搜尋，搜尋產品名稱和產品代碼
+            search_pattern = f'%{keyword}%'
+            cursor.execute('''
+                SELECT * FROM products
+                WHERE product_name LIKE ? OR product_code LIKE ?
+                ORDER BY product_name
+                LIMIT 20
+            ''', (search_pattern, search_pattern))
 
-        products = cursor.fetchall()
-        conn.close()
+            products = cursor.fetchall()
 
         if products:
             return jsonify([dict(product) for product in products])
@@ -372,35 +840,27 @@ def save_inventory():
         if not all([qr_code, warehouse_code, quantity is not None]):
             return jsonify({'success': False, 'error': '缺少必要資料'})
         
-        conn = get_inventory_db_connection('inventory_records.db')
+        conn = get_conn()
         cursor = conn.cursor()
         
-        # 檢查今日是否已有相同產品和倉別的記錄
+        # 今日已有相同產品和倉別的記錄時只更新數量，否則新增
+        # （產品名稱、倉別名稱以資料庫為準，查無資料時才使用前端傳入值）
         today = date.today()
         cursor.execute('''
-            SELECT id FROM inventory_records 
-            WHERE user_id = ? AND qr_code = ? AND warehouse_code = ? AND inventory_date = ?
-        ''', (user_id, qr_code, warehouse_code, today))
-        
-        existing_record = cursor.fetchone()
-        
-        if existing_record:
-            # 更新現有記錄
-            cursor.execute('''
-                UPDATE inventory_records 
-                SET quantity = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (quantity, existing_record['id']))
-        else:
-            # 新增記錄
-            cursor.execute('''
-                INSERT INTO inventory_records 
-                (user_id, qr_code, product_name, warehouse_code, warehouse_name, quantity, inventory_date, inventory_time)
-                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, qr_code, product_name, warehouse_code, warehouse_name, quantity, today))
+            INSERT INTO inventory_records 
+            (user_id, qr_code, product_name, warehouse_code, warehouse_name, quantity, inventory_date, inventory_time)
+            SELECT ?, ?,
+                   COALESCE((SELECT product_name FROM products WHERE qr_code = ? LIMIT 1), ?),
+                   ?,
+                   COALESCE((SELECT warehouse_name FROM warehouses WHERE warehouse_code = ? LIMIT 1), ?),
+                   ?, ?, CURRENT_TIMESTAMP
+            WHERE 1
+            ON CONFLICT(user_id, qr_code, warehouse_code, inventory_date)
+            DO UPDATE SET quantity = excluded.quantity, updated_at = CURRENT_TIMESTAMP
+        ''', (user_id, qr_code, qr_code, product_name, warehouse_code, warehouse_code, warehouse_name, quantity, today))
         
         conn.commit()
-        conn.close()
+        invalidate_stats_cache()
         
         return jsonify({'success': True, 'message': '盤點記錄儲存成功'})
         
@@ -416,7 +876,7 @@ def get_today_records():
         user_id = session.get('username')
         today = date.today()
         
-        conn = get_inventory_db_connection('inventory_records.db')
+        conn = get_conn()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -426,7 +886,6 @@ def get_today_records():
         ''', (user_id, today))
         
         records = cursor.fetchall()
-        conn.close()
         
         return jsonify([dict(record) for record in records])
         
@@ -446,7 +905,7 @@ def update_inventory(record_id):
         if quantity is None:
             return jsonify({'success': False, 'error': '缺少數量資料'})
 
-        conn = get_inventory_db_connection('inventory_records.db')
+        conn = get_conn()
         cursor = conn.cursor()
 
         # 確認記錄屬於當前使用者
@@ -458,10 +917,9 @@ def update_inventory(record_id):
 
         if cursor.rowcount > 0:
             conn.commit()
-            conn.close()
+            invalidate_stats_cache()
             return jsonify({'success': True, 'message': '記錄更新成功'})
         else:
-            conn.close()
             return jsonify({'success': False, 'error': '找不到記錄或無權限修改'})
 
     except Exception as e:
@@ -475,7 +933,7 @@ def delete_inventory(record_id):
     try:
         user_id = session.get('username')
 
-        conn = get_inventory_db_connection('inventory_records.db')
+        conn = get_conn()
         cursor = conn.cursor()
 
         # 確認記錄屬於當前使用者且是今日記錄
@@ -487,10 +945,9 @@ def delete_inventory(record_id):
 
         if cursor.rowcount > 0:
             conn.commit()
-            conn.close()
+            invalidate_stats_cache()
             return jsonify({'success': True, 'message': '記錄刪除成功'})
         else:
-            conn.close()
             return jsonify({'success': False, 'error': '找不到記錄或無權限刪除'})
 
     except Exception as e:
@@ -505,7 +962,7 @@ def get_user_warehouse():
         user_id = session.get('username')
         today = date.today()
 
-        conn = get_inventory_db_connection('inventory_records.db')
+        conn = get_conn()
         cursor = conn.cursor()
 
         # 查詢今日第一筆記錄的倉別
@@ -518,7 +975,6 @@ def get_user_warehouse():
         ''', (user_id, today))
 
         result = cursor.fetchone()
-        conn.close()
 
         if result:
             return jsonify({
@@ -3,7 +3,7 @@
 """
 Import user accounts from Excel into database/id_database.db (table: id_data).
 - Adds missing columns: department (TEXT), is_supervisor (TEXT)
-- Upserts by username (update if exists, otherwise insert)
+- Upserts by username (update if exists, otherwise insert) in one batched statement
 - Creates a timestamped backup before writing
 """
 
@@ -12,7 +12,7 @@ import sys
 import shutil
 import sqlite3
 from datetime import datetime
-from typing import List
+from typing import List, Tuple
 
 import pandas as pd
 
@@ -35,82 +35,52 @@ def get_table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
     return [row[1] for row in cur.fetchall()]
 
 
-def add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, col_type: str) -> None:
+def add_columns_if_missing(conn: sqlite3.Connection, table: str, columns: List[Tuple[str, str]]) -> None:
+    # One PRAGMA table_info read for the whole batch
     cols = set(get_table_columns(conn, table))
-    if column not in cols:
-        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type};")
-
-
-def upsert_user(conn: sqlite3.Connection, row: dict) -> None:
-    # Upsert by username: try update, if 0 rows affected then insert
-    cur = conn.execute(
-        """
-        UPDATE id_data
-        SET password = COALESCE(?, password),
-            name = COALESCE(?, name),
-            department = COALESCE(?, department),
-            is_supervisor = COALESCE(?, is_supervisor),
-            is_resigned = COALESCE(?, is_resigned)
-        WHERE username = ?
-        """,
-        (
-            row.get('password'),
-            row.get('name'),
-            row.get('department'),
-            row.get('is_supervisor'),
-            row.get('is_resigned'),
-            row['username'],
-        ),
-    )
-    if cur.rowcount == 0:
-        conn.execute(
-            """
-            INSERT INTO id_data (username, password, name, department, is_supervisor, is_resigned)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                row['username'],
-                row.get('password', ''),
-                row.get('name', ''),
-                row.get('department', ''),
-                row.get('is_supervisor', ''),
-                row.get('is_resigned', ''),
-            ),
-        )
-
-
-def normalize_is_supervisor(val):
-    if pd.isna(val):
-        return ''
-    s = str(val).strip()
-    if not s:
-        return ''
-    # Accept common truthy values
-    truthy = {'y', 'yes', 'true', '1', 't', '是', '主管'}
-    falsy = {'n', 'no', 'false', '0', 'f', '否'}
-    ls = s.lower()
-    if ls in truthy:
-        return 'Y'
-    if ls in falsy:
-        return 'N'
-    # pass-through original (e.g., already 'Y'/'N')
-    return s
-
-
-def normalize_is_resigned(val):
-    if pd.isna(val):
-        return ''
-    s = str(val).strip()
-    if not s:
-        return ''
-    truthy = {'y', 'yes', 'true', '1', 't', '是', '離職', '已離職'}
-    falsy = {'n', 'no', 'false', '0', 'f', '否', '在職'}
-    ls = s.lower()
-    if ls in truthy:
-        return 'Y'
-    if ls in falsy:
-        return 'N'
-    return s
+    for column, col_type in columns:
+        if column not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type};")
+
+
+UPSERT_USER_SQL = """
+    INSERT INTO id_data (username, password, name, department, is_supervisor, is_resigned)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET
+        password = COALESCE(excluded.password, password),
+        name = COALESCE(excluded.name, name),
+        department = COALESCE(excluded.department, department),
+        is_supervisor = COALESCE(excluded.is_supervisor, is_supervisor),
+        is_resigned = COALESCE(excluded.is_resigned, is_resigned)
+"""
+
+UPSERT_COLUMNS = ['username', 'password', 'name', 'department', 'is_supervisor', 'is_resigned']
+
+
+def ensure_username_unique(conn: sqlite3.Connection) -> None:
+    # ON CONFLICT(username) needs a unique index on username
+    try:
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_id_data_username ON id_data(username);")
+    except sqlite3.IntegrityError:
+        print("ERROR: id_data contains duplicate usernames; resolve them before importing")
+        sys.exit(1)
+
+
+# Flag spellings accepted from the sheet (compared lowercased); anything else passes through as-is
+SUPERVISOR_MAP = {
+    **dict.fromkeys(['y', 'yes', 'true', '1', 't', '是', '主管'], 'Y'),
+    **dict.fromkeys(['n', 'no', 'false', '0', 'f', '否'], 'N'),
+}
+RESIGNED_MAP = {
+    **dict.fromkeys(['y', 'yes', 'true', '1', 't', '是', '離職', '已離職'], 'Y'),
+    **dict.fromkeys(['n', 'no', 'false', '0', 'f', '否', '在職'], 'N'),
+}
+
+
+def normalize_flag(series: pd.Series, mapping: dict) -> pd.Series:
+    # Vectorized: strip, map known spellings to Y/N, keep other text, blank for missing
+    s = series.astype('string').str.strip()
+    return s.str.lower().map(mapping).fillna(s).fillna('').astype(object)
 
 
 def main():
@@ -148,8 +118,8 @@ def main():
     df['password'] = df['password'].astype(str).str.strip()
     df['name'] = df['name'].astype(str).str.strip()
     df['department'] = df['department'].astype(str).fillna('').str.strip()
-    df['is_supervisor'] = df['is_supervisor'].apply(normalize_is_supervisor)
-    df['is_resigned'] = df['is_resigned'].apply(normalize_is_resigned)
+    df['is_supervisor'] = normalize_flag(df['is_supervisor'], SUPERVISOR_MAP)
+    df['is_resigned'] = normalize_flag(df['is_resigned'], RESIGNED_MAP)
 
     # Drop empty usernames
     df = df[df['username'] != '']
@@ -166,23 +136,18 @@ def main():
     # Apply to DB
     with sqlite3.connect(db_path) as conn:
         # Ensure columns exist
-        add_column_if_missing(conn, 'id_data', 'department', 'TEXT')
-        add_column_if_missing(conn, 'id_data', 'is_supervisor', 'TEXT')
-        add_column_if_missing(conn, 'id_data', 'is_resigned', 'TEXT')
-
-        # Process rows
-        processed = 0
-        for _, r in df.iterrows():
-            row = {
-                'username': r['username'],
-                'password': r.get('password', ''),
-                'name': r.get('name', ''),
-                'department': r.get('department', ''),
-                'is_supervisor': r.get('is_supervisor', ''),
-                'is_resigned': r.get('is_resigned', ''),
-            }
-            upsert_user(conn, row)
-            processed += 1
+        add_columns_if_missing(conn, 'id_data', [
+            ('department', 'TEXT'),
+            ('is_supervisor', 'TEXT'),
+            ('is_resigned', 'TEXT'),
+        ])
+
+        ensure_username_unique(conn)
+
+        # One prepared UPSERT for all rows, in a single transaction
+        # itertuples feeds plain tuples straight into executemany (no per-row Series or list copy)
+        conn.executemany(UPSERT_USER_SQL, df[UPSERT_COLUMNS].itertuples(index=False, name=None))
+        processed = len(df)
 
         conn.commit()
 
@@ -1,9 +1,13 @@
+import atexit
 import os
 import sqlite3
+import tempfile
 import threading
-from datetime import datetime
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_from_directory
-from werkzeug.utils import secure_filename
+from collections import OrderedDict
+from urllib.parse import quote
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_from_directory, abort, current_app
+from werkzeug.formparser import parse_form_data
+from werkzeug.utils import secure_filename, safe_join, send_file as _wz_send_file
 
 # 建立 Blueprint
 warranty_bp = Blueprint(
@@ -15,26 +19,105 @@ warranty_bp = Blueprint(
 # --- 設定 ---
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'database', 'warranty.db')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif'})
+# 照片交給前端伺服器傳送："" = 由 Flask 串流，"x-sendfile"（Apache/IIS 模組），"x-accel"（nginx）
+SENDFILE_MODE = os.getenv('WARRANTY_SENDFILE_MODE', '').strip().lower()
+# x-accel 時 nginx 需設定 internal location，alias 到 UPLOAD_FOLDER
+ACCEL_PREFIX = os.getenv('WARRANTY_ACCEL_PREFIX', '/_warranty_uploads/')
 
-# 用於確保資料庫只初始化一次
-db_initialized = False
-db_lock = threading.Lock()
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+
+# --- 常用 SQL（固定字串，讓連線的 statement cache 直接命中）---
+UPSERT_CUSTOMER_SQL = """
+    INSERT INTO customers (mobile_phone, name, email, birthday, address)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(mobile_phone) DO UPDATE SET
+        name = excluded.name,
+        email = COALESCE(NULLIF(excluded.email, ''), customers.email),
+        birthday = COALESCE(NULLIF(excluded.birthday, ''), customers.birthday),
+        address = excluded.address
+    WHERE customers.name IS NOT excluded.name
+       OR customers.address IS NOT excluded.address
+       OR (NULLIF(excluded.email, '') IS NOT NULL AND customers.email IS NOT excluded.email)
+       OR (NULLIF(excluded.birthday, '') IS NOT NULL AND customers.birthday IS NOT excluded.birthday)
+"""
+INSERT_REGISTRATION_SQL = """
+    INSERT INTO registrations
+    (customer_phone, card_number, purchase_store, product_name, product_model, ship_date, photo_filename)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+VIEW_VERSION_SQL = "SELECT COUNT(*), MAX(id) FROM registrations"
+SELECT_REGISTRATIONS_SQL = """
+    SELECT
+        c.name,
+        c.mobile_phone,
+        c.email,
+        c.birthday,
+        c.address,
+        r.card_number,
+        r.purchase_store,
+        r.product_name,
+        r.product_model,
+        r.ship_date,
+        r.photo_filename,
+        r.created_at
+    FROM
+        registrations r
+    JOIN
+        customers c ON r.customer_phone = c.mobile_phone
+    ORDER BY
+        r.created_at DESC
+"""
+
+# 保固資料查詢頁：(版本, 已產生的 HTML)
+_view_cache = (None, None)
+
+# 最近已登錄的卡號（登錄資料不會刪除，命中即為重複，不必再進資料庫）
+SEEN_CARDS_MAX = 1024
+_seen_cards = OrderedDict()
+_seen_cards_lock = threading.Lock()
+
+# 每個工作執行緒保留一條資料庫連線，跨請求重複使用
+_tls = threading.local()
+_all_connections = []
+_connections_lock = threading.Lock()
 
 # --- 輔助函式 ---
 
 def get_db_connection():
-    """建立並返回資料庫連線"""
-    db_dir = os.path.dirname(DATABASE_PATH)
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-    conn = sqlite3.connect(DATABASE_PATH)
+    """返回目前執行緒的資料庫連線（第一次呼叫時建立）"""
+    conn = getattr(_tls, 'conn', None)
+    if conn is not None:
+        return conn
+    # check_same_thread=False 只是為了讓結束時能由主執行緒關閉；使用上仍是一執行緒一連線
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # 寫入鎖被占用時最多等 5 秒，而不是立即回報 database is locked
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    _tls.conn = conn
+    with _connections_lock:
+        _all_connections.append(conn)
     return conn
 
+@atexit.register
+def close_db_connections():
+    """程式結束時關閉所有執行緒的連線"""
+    with _connections_lock:
+        for conn in _all_connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _all_connections.clear()
+
 def init_db():
     """清除現有資料並建立新資料表"""
     db = get_db_connection()
+    # WAL 模式會記錄在資料庫檔案中，只需設定一次；讀取不再被寫入阻塞
+    db.execute("PRAGMA journal_mode=WAL")
     cursor = db.cursor()
     # 建立客戶資料表
     cursor.execute('''
@@ -61,123 +144,170 @@ def init_db():
             FOREIGN KEY (customer_phone) REFERENCES customers (mobile_phone)
         );
     ''')
+    # 查詢頁依建立時間排序，直接沿索引讀取免排序；客戶關聯欄位也建立索引
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reg_created ON registrations(created_at DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reg_customer ON registrations(customer_phone)")
     db.commit()
-    db.close()
-    global db_initialized
-    db_initialized = True
+
+    # 以最近的登錄卡號預熱重複卡號快取
+    recent = cursor.execute(
+        "SELECT card_number FROM registrations ORDER BY id DESC LIMIT ?", (SEEN_CARDS_MAX,)
+    ).fetchall()
+    for row in reversed(recent):
+        remember_card(row[0])
+
+def remember_card(card_number):
+    """記錄已登錄的卡號，超過上限時淘汰最久未用到的"""
+    with _seen_cards_lock:
+        _seen_cards[card_number] = True
+        _seen_cards.move_to_end(card_number)
+        if len(_seen_cards) > SEEN_CARDS_MAX:
+            _seen_cards.popitem(last=False)
+
+def card_seen(card_number):
+    """卡號是否已知被登錄過（未命中不代表沒登錄，仍以 UNIQUE 限制為準）"""
+    with _seen_cards_lock:
+        if card_number in _seen_cards:
+            _seen_cards.move_to_end(card_number)
+            return True
+        return False
 
 def allowed_file(filename):
     """檢查上傳的檔案副檔名是否合法"""
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, sep, ext = filename.rpartition('.')
+    return bool(sep) and ext.lower() in ALLOWED_EXTENSIONS
+
+def parse_upload_form():
+    """以 Werkzeug 的串流 multipart 解析器讀取表單，返回 (form, files, parts)
+
+    上傳檔案直接寫入 UPLOAD_FOLDER 的暫存檔，不經過系統暫存目錄再複製一次；
+    各項上限沿用 request.form 的設定。parts 是所有已建立的暫存檔（包含解析
+    中斷、沒有出現在 files 裡的），用完交給 discard_uploads 清除。
+    """
+    created = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        part = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, suffix='.part', delete=False)
+        created.append(part)
+        return part
+
+    try:
+        _, form, files = parse_form_data(
+            request.environ,
+            stream_factory=stream_factory,
+            max_form_memory_size=request.max_form_memory_size,
+            max_content_length=request.max_content_length,
+            max_form_parts=request.max_form_parts,
+        )
+    except Exception:
+        discard_uploads(created)
+        raise
+    return form, files, created
+
+def discard_uploads(parts):
+    """關閉並刪除尚未改成正式檔名的上傳暫存檔"""
+    for part in parts:
+        part.close()
+        if os.path.exists(part.name):
+            os.remove(part.name)
 
 # --- Hooks & 路由 ---
 
-@warranty_bp.before_request
-def ensure_db_initialized():
-    """在每個請求之前，確保資料庫已初始化"""
-    global db_initialized
-    if not db_initialized:
-        with db_lock:
-            if not db_initialized:
-                init_db()
+@warranty_bp.record_once
+def init_db_on_register(state):
+    """Blueprint 註冊到 app 時初始化資料庫一次（資料表皆為 IF NOT EXISTS，可重複執行）"""
+    init_db()
 
 @warranty_bp.route('/register', methods=['GET', 'POST'])
 def register():
     """處理保固登錄頁面的 GET 和 POST 請求"""
     if request.method == 'POST':
-        # 從表單中獲取資料
-        name = request.form.get('name')
-        mobile_phone = request.form.get('mobile_phone')
-        email = request.form.get('email')
-        birthday = request.form.get('birthday')
-        address = request.form.get('address')
-        card_number = request.form.get('card_number')
-        purchase_store = request.form.get('purchase_store')
-        product_name = request.form.get('product_name')
-        product_model = request.form.get('product_model')
-        ship_date = request.form.get('ship_date')
-        file = request.files.get('warranty_photo')
-
-        # --- 資料驗證 ---
-        if not all([name, mobile_phone, address, card_number, product_name, product_model, ship_date]) or not file or not file.filename:
-            flash('所有欄位及保固書照片皆為必填！', 'danger')
-            return redirect(request.url)
-
-        if not allowed_file(file.filename):
-            flash('僅允許上傳圖片檔案 (png, jpg, jpeg, gif)！', 'danger')
-            return redirect(request.url)
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
+        form, files, parts = parse_upload_form()
         try:
-            # 檢查服務保證書卡號是否已存在
-            cursor.execute("SELECT id FROM registrations WHERE card_number = ?", (card_number,))
-            if cursor.fetchone():
-                flash(f'服務保證書卡號 {card_number} 已經被註冊過了。', 'warning')
-                conn.close()
-                return redirect(request.url)
-
-            # --- 處理檔案上傳 ---
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            unique_filename = f"{timestamp}_{filename}"
-            
-            if not os.path.exists(UPLOAD_FOLDER):
-                os.makedirs(UPLOAD_FOLDER)
-            
-            file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
-            file.save(file_path)
-
-            # --- 處理客戶資料 ---
-            cursor.execute("SELECT * FROM customers WHERE mobile_phone = ?", (mobile_phone,))
-            customer = cursor.fetchone()
-
-            if customer:
-                # 更新現有客戶資料 (如果表單中的資料和資料庫中的不同)
-                updates = {}
-                if name and customer['name'] != name: updates['name'] = name
-                if email and customer['email'] != email: updates['email'] = email
-                if birthday and customer['birthday'] != birthday: updates['birthday'] = birthday
-                if address and customer['address'] != address: updates['address'] = address
-                
-                if updates:
-                    set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
-                    values = list(updates.values())
-                    values.append(mobile_phone)
-                    cursor.execute(f"UPDATE customers SET {set_clause} WHERE mobile_phone = ?", tuple(values))
-            else:
-                # 新增客戶
-                cursor.execute(
-                    "INSERT INTO customers (mobile_phone, name, email, birthday, address) VALUES (?, ?, ?, ?, ?)",
-                    (mobile_phone, name, email, birthday, address)
-                )
-
-            # --- 插入保固註冊資料 ---
-            cursor.execute(
-                """
-                INSERT INTO registrations 
-                (customer_phone, card_number, purchase_store, product_name, product_model, ship_date, photo_filename)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (mobile_phone, card_number, purchase_store, product_name, product_model, ship_date, unique_filename)
-            )
-
-            conn.commit()
-            flash('保固資料登錄成功！感謝您的填寫。', 'success')
-
-        except sqlite3.IntegrityError:
-            flash(f'資料儲存失敗，服務保證書卡號 {card_number} 可能已經被註冊過了。', 'danger')
-        except Exception as e:
-            flash(f'發生未知錯誤：{str(e)}', 'danger')
+            return register_submission(form, files)
         finally:
-            if conn:
-                conn.close()
+            discard_uploads(parts)
+
+    return render_template('warranty_registration.html')
+
+def register_submission(form, files):
+    """寫入一筆保固登錄（form/files 來自 parse_upload_form）"""
+    # 從表單中獲取資料
+    name = form.get('name')
+    mobile_phone = form.get('mobile_phone')
+    email = form.get('email')
+    birthday = form.get('birthday')
+    address = form.get('address')
+    card_number = form.get('card_number')
+    purchase_store = form.get('purchase_store')
+    product_name = form.get('product_name')
+    product_model = form.get('product_model')
+    ship_date = form.get('ship_date')
+    file = files.get('warranty_photo')
+
+    # --- 資料驗證 ---
+    if not all([name, mobile_phone, address, card_number, product_name, product_model, ship_date]) or not file or not file.filename:
+        flash('所有欄位及保固書照片皆為必填！', 'danger')
+        return redirect(request.url)
 
+    if not allowed_file(file.filename):
+        flash('僅允許上傳圖片檔案 (png, jpg, jpeg, gif)！', 'danger')
+        return redirect(request.url)
+
+    if card_seen(card_number):
+        flash(f'服務保證書卡號 {card_number} 已經被註冊過了。', 'warning')
         return redirect(url_for('warranty.register'))
 
-    return render_template('warranty_registration.html')
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    file_path = None
+    try:
+        # 以隨機前綴取代時間戳記，同一秒內上傳的同名照片不會互相覆蓋
+        filename = secure_filename(file.filename)
+        unique_filename = f"{os.urandom(6).hex()}_{filename}"
+
+        # 一開始就取得寫入鎖，客戶與註冊資料在同一筆交易中寫入、只提交一次
+        conn.execute("BEGIN IMMEDIATE")
+
+        # --- 處理客戶資料 ---
+        # 新客戶直接新增；既有客戶只更新有填寫且不同的欄位（email、生日未填時保留原值）
+        cursor.execute(UPSERT_CUSTOMER_SQL, (mobile_phone, name, email, birthday, address))
+
+        # --- 插入保固註冊資料 ---
+        cursor.execute(
+            INSERT_REGISTRATION_SQL,
+            (mobile_phone, card_number, purchase_store, product_name, product_model, ship_date, unique_filename)
+        )
+
+        # --- 處理檔案上傳（卡號重複時上面已拋出 IntegrityError，照片不會改成正式檔名）---
+        # 照片在解析表單時已寫入 UPLOAD_FOLDER 的暫存檔，關閉後改名即可（Windows 無法改名開啟中的檔案）
+        file.stream.close()
+        target = os.path.join(UPLOAD_FOLDER, unique_filename)
+        os.replace(file.stream.name, target)
+        file_path = target
+
+        conn.commit()
+        file_path = None
+        remember_card(card_number)
+        flash('保固資料登錄成功！感謝您的填寫。', 'success')
+
+    except sqlite3.IntegrityError as e:
+        # 卡號重複由 card_number 的 UNIQUE 限制擋下，不另外先查詢
+        conn.rollback()
+        if 'registrations.card_number' in str(e):
+            remember_card(card_number)
+            flash(f'服務保證書卡號 {card_number} 已經被註冊過了。', 'warning')
+        else:
+            flash(f'資料儲存失敗，服務保證書卡號 {card_number} 可能已經被註冊過了。', 'danger')
+    except Exception as e:
+        conn.rollback()
+        # 交易未完成時清掉已改名的照片，避免留下沒有對應記錄的檔案（暫存檔由 discard_uploads 清除）
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+        flash(f'發生未知錯誤：{str(e)}', 'danger')
+
+    return redirect(url_for('warranty.register'))
 
 @warranty_bp.route('/view')
 def view():
@@ -190,34 +320,46 @@ def view():
 
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT
-            c.name,
-            c.mobile_phone,
-            c.email,
-            c.birthday,
-            c.address,
-            r.card_number,
-            r.purchase_store,
-            r.product_name,
-            r.product_model,
-            r.ship_date,
-            r.photo_filename,
-            r.created_at
-        FROM
-            registrations r
-        JOIN
-            customers c ON r.customer_phone = c.mobile_phone
-        ORDER BY
-            r.created_at DESC
-    """)
-    registrations = cursor.fetchall()
-    conn.close()
-    
-    return render_template('warranty_view.html', registrations=registrations)
+
+    # 登錄資料只會新增，以筆數與最大 id 當版本：未變動時回 304，或重用已產生的頁面
+    count, max_id = cursor.execute(VIEW_VERSION_SQL).fetchone()
+    etag = f"reg-{count}-{max_id}"
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        global _view_cache
+        cached_etag, html = _view_cache
+        if cached_etag != etag:
+            cursor.execute(SELECT_REGISTRATIONS_SQL)
+            registrations = cursor.fetchall()
+            html = render_template('warranty_view.html', registrations=registrations)
+            _view_cache = (etag, html)
+        response = current_app.make_response(html)
+    response.set_etag(etag)
+    # 每次都向伺服器確認版本，只有本人瀏覽器可快取
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @warranty_bp.route('/uploads/<filename>')
 def uploaded_file(filename):
     if 'logged_in' not in session:
         return "Forbidden", 403
-    return send_from_directory(UPLOAD_FOLDER, filename)
\ No newline at end of file
+    if SENDFILE_MODE not in ('x-sendfile', 'x-accel'):
+        return send_from_directory(UPLOAD_FOLDER, filename)
+
+    # 只回傳標頭，檔案內容由前端伺服器以 sendfile(2) 傳送
+    file_path = safe_join(UPLOAD_FOLDER, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    rv = _wz_send_file(
+        file_path,
+        request.environ,
+        use_x_sendfile=True,
+        response_class=current_app.response_class,
+        _root_path=current_app.root_path,
+    )
+    if SENDFILE_MODE == 'x-accel':
+        rv.headers.pop('X-Sendfile', None)
+        rv.headers.pop('Content-Length', None)
+        rv.headers['X-Accel-Redirect'] = ACCEL_PREFIX + quote(filename)
+    return rv
\ No newline at end of file